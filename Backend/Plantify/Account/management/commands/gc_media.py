@@ -0,0 +1,104 @@
+import os
+import time
+from collections import Counter
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.utils import timezone
+
+from Account.models import StoredFile
+from Account.storage import CONTENT_NAME_RE, DERIVED_NAME_RE, ContentAddressedStorage, content_addressed_storage
+
+
+def count_references():
+    """Number of rows referring to each file, over every FileField on ContentAddressedStorage."""
+    references = Counter()
+    for model in apps.get_models():
+        for field in model._meta.get_fields():
+            if not isinstance(field, models.FileField) or not isinstance(field.storage, ContentAddressedStorage):
+                continue
+            rows = (model._default_manager.exclude(**{field.name: ''}).order_by()
+                    .values_list(field.name).annotate(count=models.Count('pk')))
+            for name, count in rows.iterator():
+                references[name] += count
+    return references
+
+
+class Command(BaseCommand):
+    help = (
+        'Garbage-collect content-addressed media: reset every reference count to the number of '
+        'rows that actually use the file, delete files nothing refers to, and delete hashed files '
+        'on disk that the database doesn\'t know about.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=3600,
+                            help='Leave files touched in the last this many seconds alone (their '
+                                 'rows may not be committed yet)')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without changing it')
+
+    def handle(self, *args, **options):
+        storage = content_addressed_storage
+        dry_run = options['dry_run']
+        cutoff = timezone.now() - timezone.timedelta(seconds=options['min_age'])
+        references = count_references()
+        deleted = deleted_bytes = fixed = adopted = untracked = 0
+
+        for stored in StoredFile.objects.filter(updated_at__lt=cutoff).iterator():
+            actual = references.get(stored.name, 0)
+            if actual == stored.refcount:
+                continue
+            if dry_run:
+                deleted += actual == 0
+                deleted_bytes += stored.size if actual == 0 else 0
+                fixed += actual != 0
+                continue
+            with transaction.atomic():
+                # Skip it if a save or delete touched it since the references were counted
+                locked = StoredFile.objects.select_for_update().filter(pk=stored.pk, updated_at__lt=cutoff).first()
+                if locked is None:
+                    continue
+                if actual == 0:
+                    locked.delete()
+                    storage.delete_file(stored.name)
+                    deleted += 1
+                    deleted_bytes += stored.size
+                else:
+                    StoredFile.objects.filter(pk=stored.pk).update(refcount=actual)
+                    fixed += 1
+
+        # Referenced hashed files without a row (e.g. restored from a backup)
+        tracked = set(StoredFile.objects.values_list('name', flat=True))
+        for name, count in references.items():
+            if CONTENT_NAME_RE.search(name) and name not in tracked and storage.exists(name):
+                if not dry_run:
+                    StoredFile.objects.get_or_create(name=name, defaults={'refcount': count, 'size': storage.size(name)})
+                adopted += 1
+
+        # Hashed files on disk that no row knows about (e.g. a crash between writing and
+        # committing), and files derived from a hashed file that is gone
+        oldest = time.time() - options['min_age']
+        tracked = set(StoredFile.objects.values_list('name', flat=True))
+        tracked_stems = {os.path.splitext(name)[0] for name in tracked}
+        for dirpath, dirnames, filenames in os.walk(storage.location):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, storage.location).replace(os.sep, '/')
+                derived = DERIVED_NAME_RE.search(name)
+                if derived:
+                    if name.rsplit('_', 1)[0] in tracked_stems:
+                        continue
+                elif not CONTENT_NAME_RE.search(name) or name in tracked or name in references:
+                    continue
+                if os.path.getmtime(path) >= oldest:
+                    continue
+                if not dry_run:
+                    os.remove(path)
+                untracked += 1
+
+        prefix = 'Dry run, nothing changed:' if dry_run else 'Garbage collection:'
+        self.stdout.write(
+            f'{prefix} deleted {deleted} unreferenced files ({deleted_bytes} bytes) and {untracked} untracked '
+            f'files, fixed {fixed} reference counts, adopted {adopted} files'
+        )
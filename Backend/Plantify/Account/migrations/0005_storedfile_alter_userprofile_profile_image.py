@@ -0,0 +1,30 @@
+# Generated by Django 5.1.7 on 2026-10-18 07:22
+
+import Account.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Account', '0004_passwordresettoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='profile_image',
+            field=models.ImageField(default='default.jpg', storage=Account.storage.ContentAddressedStorage(), upload_to='profile_pics/'),
+        ),
+    ]
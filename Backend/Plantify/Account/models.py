@@ -6,6 +6,7 @@ import os
 from django.utils import timezone
 import random
 import string
+from .storage import content_addressed_storage
 
 class CustomUserManager(BaseUserManager):
     use_in_migrations = True
@@ -71,7 +72,7 @@ class UserProfile(models.Model):
     address = models.CharField(max_length=100, blank=True)
     dob = models.DateField(null=True, blank=True)
     phone = models.CharField(max_length=10, blank=True)
-    profile_image = models.ImageField(upload_to='profile_pics/', default='default.jpg')
+    profile_image = models.ImageField(upload_to='profile_pics/', default='default.jpg', storage=content_addressed_storage)
     is_email_verified = models.BooleanField(default=False)
 
     def __str__(self):
@@ -145,3 +146,13 @@ class PasswordResetToken(models.Model):
         return reset_token
 
 
+class StoredFile(models.Model):
+    """A file in ContentAddressedStorage and the number of references to it."""
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField(default=0)
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} references)"
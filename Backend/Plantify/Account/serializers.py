@@ -2,11 +2,13 @@ from Account.models import CustomUser, EmailVerification
 from django.contrib.auth.password_validation import validate_password
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework import serializers
+from django.conf import settings
 from rest_framework.validators import UniqueValidator
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.contrib.auth.models import User
 from .models import UserProfile, PasswordResetToken
 from .utils import validate_password_strength
+from .thumbnails import derivative_names, derivative_storage
 
 
 class CiustomUserSerializer(serializers.ModelSerializer):
@@ -46,10 +48,11 @@ class ProfileSerializer(serializers.ModelSerializer):
     last_name = serializers.CharField(source='user.last_name', required=False)
     email = serializers.EmailField(source='user.email', required=False)
     image_url = serializers.SerializerMethodField()
+    image_urls = serializers.SerializerMethodField()
 
     class Meta:
         model = UserProfile
-        fields = ['user', 'first_name', 'last_name', 'email', 'bio', 'profile_image', 'address', 'dob', 'phone', 'image_url']
+        fields = ['user', 'first_name', 'last_name', 'email', 'bio', 'profile_image', 'address', 'dob', 'phone', 'image_url', 'image_urls']
 
     def get_image_url(self, obj):
         if obj.profile_image and hasattr(obj.profile_image, 'url'):
@@ -59,6 +62,17 @@ class ProfileSerializer(serializers.ModelSerializer):
             return obj.profile_image.url
         return '/media/profile_pics/default.jpg'
 
+    def get_image_urls(self, obj):
+        # Thumbnail URL per size; the original until its thumbnails have been generated
+        original = self.get_image_url(obj)
+        request = self.context.get('request')
+        urls = {}
+        for size, name in derivative_names(obj.profile_image.name).items():
+            if derivative_storage.exists(name):
+                url = derivative_storage.url(name)
+                urls[str(size)] = request.build_absolute_uri(url) if request else url
+        return {str(size): urls.get(str(size), original) for size in settings.PROFILE_IMAGE_THUMBNAIL_SIZES}
+
     def validate_profile_image(self, value):
         if value:
             if value.size > 5 * 1024 * 1024:  # 5MB limit
@@ -0,0 +1,97 @@
+import hashlib
+import os
+import posixpath
+import re
+
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+# <upload_to>/<first two hex digits>/<sha256><extension>
+CONTENT_NAME_RE = re.compile(r'(^|/)[0-9a-f]{2}/[0-9a-f]{64}(\.[^/]*)?$')
+# Files generated from a stored file (e.g. thumbnails): <sha256>_<suffix>
+DERIVED_NAME_RE = re.compile(r'(^|/)[0-9a-f]{2}/([0-9a-f]{64})_[^/]+$')
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that names files after the SHA-256 of their bytes, so
+    identical uploads are stored once.
+
+    Every save of a file adds a reference to its StoredFile row and every
+    delete removes one; the file itself is only deleted with its last
+    reference, so deleting one model's file never breaks another model that
+    holds the same bytes. Derived files stored next to it (``<sha256>_*``,
+    such as thumbnails) are deleted along with it. Files saved before this
+    storage was used (names that aren't content hashes) are deleted directly,
+    as before.
+    """
+
+    def content_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        hexdigest = digest.hexdigest()
+        extension = os.path.splitext(name)[1].lower()
+        return posixpath.join(posixpath.dirname(name), hexdigest[:2], hexdigest + extension)
+
+    def get_available_name(self, name, max_length=None):
+        # A content-addressed name that exists already holds these exact bytes
+        if CONTENT_NAME_RE.search(name) and self.exists(name):
+            raise FileExistsError(name)
+        return super().get_available_name(name, max_length)
+
+    def _save(self, name, content):
+        from .models import StoredFile
+
+        name = self.content_name(name, content)
+        with transaction.atomic():
+            # The row lock orders this against a delete of the last reference
+            stored, created = StoredFile.objects.select_for_update().get_or_create(
+                name=name, defaults={'size': content.size}
+            )
+            StoredFile.objects.filter(pk=stored.pk).update(refcount=F('refcount') + 1, updated_at=timezone.now())
+            if not self.exists(name):
+                try:
+                    super()._save(name, content)
+                except FileExistsError:
+                    pass  # Written concurrently, with the same bytes
+        return name
+
+    def delete(self, name):
+        from .models import StoredFile
+
+        if not name:
+            raise ValueError('The name must be given to delete().')
+        with transaction.atomic():
+            stored = StoredFile.objects.select_for_update().filter(name=name).first()
+            if stored is None:
+                return super().delete(name)
+            if stored.refcount > 1:
+                StoredFile.objects.filter(pk=stored.pk).update(refcount=F('refcount') - 1, updated_at=timezone.now())
+                return
+            stored.delete()
+            self.delete_file(name)
+
+    def delete_file(self, name):
+        """Delete ``name`` and the files derived from it, whatever their reference count."""
+        super().delete(name)
+        directory, filename = posixpath.split(name)
+        prefix = os.path.splitext(filename)[0] + '_'
+        try:
+            filenames = self.listdir(directory)[1]
+        except FileNotFoundError:
+            return
+        for derived in filenames:
+            if derived.startswith(prefix):
+                super().delete(posixpath.join(directory, derived))
+
+    def refcount(self, name):
+        from .models import StoredFile
+
+        return StoredFile.objects.filter(name=name).values_list('refcount', flat=True).first() or 0
+
+
+content_addressed_storage = ContentAddressedStorage()
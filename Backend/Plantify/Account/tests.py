@@ -1,3 +1,148 @@
-from django.test import TestCase
+import io
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import StoredFile, UserProfile
+from .storage import content_addressed_storage
+from .thumbnails import derivative_storage, downscale_original
+
+
+def make_image_bytes(color=(40, 160, 60), size=(32, 32)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+class ContentAddressedStorageTests(TestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        users = get_user_model().objects
+        self.profiles = [
+            UserProfile.objects.create(user=users.create_user(username=email, email=email, password='x'))
+            for email in ('a@example.com', 'b@example.com')
+        ]
+
+    def put_image(self, profile, data):
+        upload = SimpleUploadedFile('me.jpg', data, content_type='image/jpeg')
+        token = AccessToken.for_user(profile.user)
+        response = self.client.put(
+            reverse('profile'), {'profile_image': upload}, format='multipart', HTTP_AUTHORIZATION=f'Bearer {token}',
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        profile.refresh_from_db()
+        return profile.profile_image.name
+
+    def test_identical_uploads_are_stored_once(self):
+        data = make_image_bytes()
+        first = self.put_image(self.profiles[0], data)
+        second = self.put_image(self.profiles[1], data)
+        self.assertEqual(first, second)
+        self.assertRegex(first, r'^profile_pics/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        self.assertEqual(content_addressed_storage.refcount(first), 2)
+
+    def test_replacing_a_shared_image_keeps_it_for_other_users(self):
+        shared = make_image_bytes()
+        self.put_image(self.profiles[0], shared)
+        name = self.put_image(self.profiles[1], shared)
+
+        self.put_image(self.profiles[0], make_image_bytes(color=(200, 30, 30)))
+        self.assertTrue(content_addressed_storage.exists(name))
+        self.assertEqual(content_addressed_storage.refcount(name), 1)
+
+        self.put_image(self.profiles[1], make_image_bytes(color=(10, 10, 200)))
+        self.assertFalse(content_addressed_storage.exists(name))
+        self.assertFalse(StoredFile.objects.filter(name=name).exists())
+
+    @override_settings(PROFILE_IMAGE_MAX_DIMENSION=16)
+    def test_replacing_a_downscaled_image_releases_the_downscaled_copy(self):
+        shared = make_image_bytes()
+        original = self.put_image(self.profiles[0], shared)
+        self.put_image(self.profiles[1], shared)
+        # The background downscale swapped the first profile to its own copy
+        downscaled = downscale_original(self.profiles[0], 16)
+        self.assertNotEqual(downscaled, original)
+
+        with mock.patch.object(UserProfile.objects, 'select_for_update',
+                               wraps=UserProfile.objects.select_for_update) as select_for_update:
+            self.put_image(self.profiles[0], make_image_bytes(color=(200, 30, 30)))
+        select_for_update.assert_called_once_with()
+        self.assertFalse(content_addressed_storage.exists(downscaled))
+        self.assertEqual(content_addressed_storage.refcount(original), 1)
+
+    def test_gc_deletes_orphans_and_fixes_refcounts(self):
+        name = self.put_image(self.profiles[0], make_image_bytes())
+        orphan = content_addressed_storage.save('profile_pics/lost.jpg', ContentFile(make_image_bytes((9, 9, 9))))
+        StoredFile.objects.filter(name=name).update(refcount=5)
+        stray = os.path.join(content_addressed_storage.location, 'profile_pics', 'ab', 'ab' + '0' * 62 + '.jpg')
+        os.makedirs(os.path.dirname(stray))
+        with open(stray, 'wb') as f:
+            f.write(b'x')
+        os.utime(stray, (0, 0))
+        StoredFile.objects.update(updated_at=timezone.now() - timezone.timedelta(days=1))
+
+        call_command('gc_media', '--dry-run', stdout=io.StringIO())
+        self.assertTrue(content_addressed_storage.exists(orphan))
+
+        call_command('gc_media', stdout=io.StringIO())
+        self.assertFalse(content_addressed_storage.exists(orphan))
+        self.assertFalse(os.path.exists(stray))
+        self.assertTrue(content_addressed_storage.exists(name))
+        self.assertEqual(content_addressed_storage.refcount(name), 1)
+
+
+@override_settings(PROFILE_IMAGE_MAX_DIMENSION=300)
+class ProfileImageDerivativeTests(TransactionTestCase):
+    client_class = APIClient
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.executor = ThreadPoolExecutor(1)
+        self.enterContext(mock.patch('Account.thumbnails._executor', self.executor))
+        user = get_user_model().objects.create_user(username='a@example.com', email='a@example.com', password='x')
+        self.profile = UserProfile.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+
+    def test_upload_is_downscaled_and_thumbnailed_in_the_background(self):
+        upload = SimpleUploadedFile('me.jpg', make_image_bytes(size=(900, 600)), content_type='image/jpeg')
+        response = self.client.put(reverse('profile'), {'profile_image': upload}, format='multipart')
+        self.assertEqual(response.status_code, 200)
+        original = response.json()['image_url']
+        # Until the thumbnails exist every size points at the original
+        self.assertEqual(set(response.json()['image_urls'].values()), {original})
+
+        self.executor.shutdown(wait=True)
+        self.profile.refresh_from_db()
+        with self.profile.profile_image.open('rb') as f:
+            self.assertEqual(Image.open(f).size, (300, 200))
+        self.assertFalse(original.endswith(self.profile.profile_image.name))
+
+        urls = self.client.get(reverse('profile')).json()['image_urls']
+        self.assertEqual(set(urls), {'64', '128', '256'})
+        for size, url in urls.items():
+            name = url.split('/media/', 1)[1]
+            with derivative_storage.open(name, 'rb') as f:
+                thumbnail = Image.open(f)
+                self.assertEqual((thumbnail.format, thumbnail.size), ('WEBP', (int(size), int(size))))
+
+        # Thumbnails go with the last reference to their original
+        self.profile.profile_image.storage.delete(self.profile.profile_image.name)
+        self.assertFalse(derivative_storage.exists(name))
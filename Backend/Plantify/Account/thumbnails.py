@@ -0,0 +1,96 @@
+import io
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from .storage import CONTENT_NAME_RE
+
+logger = logging.getLogger(__name__)
+
+# Derivatives are regenerated in place, so they overwrite instead of being renamed
+derivative_storage = FileSystemStorage(allow_overwrite=True)
+
+_executor = ThreadPoolExecutor(settings.PROFILE_IMAGE_DERIVATIVE_WORKERS, thread_name_prefix='profile-image-derivatives')
+
+
+def derivative_name(name, size):
+    # Next to a content-addressed original: <sha256>_<size>.webp
+    return f'{posixpath.splitext(name)[0]}_{size}.webp'
+
+
+def derivative_names(name):
+    """Names of the thumbnails of ``name`` by size, or {} for originals that don't get any."""
+    if not name or not CONTENT_NAME_RE.search(name):
+        return {}
+    return {size: derivative_name(name, size) for size in settings.PROFILE_IMAGE_THUMBNAIL_SIZES}
+
+
+def generate_derivatives(name, storage):
+    """Write a WebP thumbnail of the original ``name`` for every configured size."""
+    with storage.open(name, 'rb') as f:
+        image = Image.open(f)
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    for size, thumbnail_name in derivative_names(name).items():
+        thumbnail = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, format='WEBP', quality=settings.PROFILE_IMAGE_THUMBNAIL_QUALITY, method=4)
+        derivative_storage.save(thumbnail_name, ContentFile(buffer.getvalue()))
+
+
+def downscale_original(profile, max_dimension):
+    """
+    Replace the profile image with a copy no larger than ``max_dimension`` on
+    either side, if it is larger. Returns the name of the image to keep.
+    """
+    field = profile.profile_image
+    name = field.name
+    with field.storage.open(name, 'rb') as f:
+        image = Image.open(f)
+        if max(image.size) <= max_dimension:
+            return name
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=85, optimize=True)
+    new_name = field.storage.save(field.field.generate_filename(profile, 'resized.jpg'), ContentFile(buffer.getvalue()))
+
+    # Only swap if the user hasn't uploaded yet another image in the meantime
+    updated = type(profile).objects.filter(pk=profile.pk, profile_image=name).update(profile_image=new_name)
+    field.storage.delete(name if updated else new_name)
+    return new_name if updated else None
+
+
+def process_profile_image(profile_id, name):
+    from .models import UserProfile
+
+    close_old_connections()
+    try:
+        profile = UserProfile.objects.filter(pk=profile_id, profile_image=name).first()
+        if profile is None:
+            return  # Replaced before we got to it
+        if settings.PROFILE_IMAGE_MAX_DIMENSION:
+            name = downscale_original(profile, settings.PROFILE_IMAGE_MAX_DIMENSION)
+            if name is None:
+                return
+        generate_derivatives(name, profile.profile_image.storage)
+    except Exception:
+        logger.exception('Could not process profile image %s', name)
+    finally:
+        close_old_connections()
+
+
+def schedule_profile_image(profile):
+    """
+    Downscale (if configured) and thumbnail the profile's image on a background
+    thread, once the current transaction has committed.
+    """
+    profile_id, name = profile.pk, profile.profile_image.name
+    if not derivative_names(name):
+        return
+    transaction.on_commit(lambda: _executor.submit(process_profile_image, profile_id, name))
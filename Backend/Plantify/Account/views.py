@@ -15,9 +15,11 @@ from .models import UserProfile, EmailVerification, PasswordResetToken
 from rest_framework.permissions import IsAuthenticated
 from django.contrib.auth.models import User  # Import the built-in User model
 from .serializers import ProfileSerializer
+from .thumbnails import schedule_profile_image
 from django.utils import timezone
 from django.core.mail import send_mail
 from django.conf import settings 
+from django.db import transaction
 from .utils import send_otp_email, validate_password_strength, get_password_strength_score, send_email_with_fallback
 
 User = get_user_model()
@@ -378,26 +380,36 @@ class UserProfileView(APIView):
 
     def put(self, request):
         try:
-            profile = UserProfile.objects.get(user=request.user)
             data = request.data.copy()
-
             if 'profile_image' in request.FILES:
-                # Delete old image if it exists and is not the default
-                if profile.profile_image and profile.profile_image.name != 'default.jpg':
-                    try:
-                        profile.profile_image.delete(save=False)
-                    except:
-                        pass  # Ignore if file doesn't exist
                 data['profile_image'] = request.FILES['profile_image']
 
-            serializer = ProfileSerializer(profile, data=data, partial=True, context={'request': request})
-            if serializer.is_valid():
+            # The row lock orders this against the background downscale swapping
+            # the image (thumbnails.downscale_original), so old_image is the
+            # name this save actually replaces
+            with transaction.atomic():
+                profile = UserProfile.objects.select_for_update().get(user=request.user)
+                old_image = profile.profile_image.name
+                serializer = ProfileSerializer(profile, data=data, partial=True, context={'request': request})
+                if not serializer.is_valid():
+                    return Response(
+                        serializer.errors,
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
                 serializer.save()
-                return Response(serializer.data)
-            return Response(
-                serializer.errors,
-                status=status.HTTP_400_BAD_REQUEST
-            )
+                if 'profile_image' in request.FILES:
+                    # Thumbnails (and downscaling) happen after the response
+                    schedule_profile_image(profile)
+
+            if 'profile_image' in request.FILES:
+                # Drop this profile's reference to the old image once the new one is
+                # saved; the file is only removed if nothing else uses the same bytes
+                if old_image and old_image != 'default.jpg':
+                    try:
+                        profile.profile_image.storage.delete(old_image)
+                    except OSError:
+                        pass  # Ignore if file doesn't exist
+            return Response(serializer.data)
         except UserProfile.DoesNotExist:
             return Response(
                 {'error': 'Profile not found'},
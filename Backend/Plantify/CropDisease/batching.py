@@ -0,0 +1,152 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+_STOP = object()
+
+
+class _PendingSample:
+    __slots__ = ('sample', 'future', 'enqueued_at')
+
+    def __init__(self, sample):
+        self.sample = sample
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class MicroBatcher:
+    """
+    Collect single-image predictions from concurrent requests and run them
+    through the model as one batched tensor.
+
+    The batcher exposes the same ``predict(batch)`` call as a Keras model, so it
+    can be passed anywhere the model is expected. Each row of the input is
+    queued separately; a background thread gathers up to ``max_batch_size``
+    queued rows, waiting at most ``max_wait_ms`` after the oldest one arrived,
+    and hands every caller back its own row of the output.
+    """
+
+    def __init__(self, model, max_batch_size=16, max_wait_ms=5):
+        self.model = model
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._closed = False
+        self._reset_stats()
+
+    def predict(self, batch):
+        """Predict every row of ``batch``, sharing model calls with other callers."""
+        import numpy as np
+
+        futures = [self.submit(sample) for sample in batch]
+        return np.stack([future.result() for future in futures])
+
+    def submit(self, sample):
+        """
+        Queue one preprocessed image (without the batch axis).
+
+        Returns:
+            Future: resolves to the model output row for this image
+        """
+        pending = _PendingSample(sample)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Batcher has been closed')
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name='crop-disease-batcher', daemon=True
+                )
+                self._worker.start()
+            self._queue.put(pending)
+        return pending.future
+
+    def close(self, timeout=None):
+        """Stop accepting work, finish what is queued and stop the worker."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            worker = self._worker
+            self._queue.put(_STOP)
+        if worker is not None:
+            worker.join(timeout)
+
+    def stats(self):
+        """Return counters describing batch sizes and queue wait times."""
+        with self._lock:
+            batches = self._batches
+            samples = self._samples
+            return {
+                'batches': batches,
+                'samples': samples,
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'batch_size_counts': dict(sorted(self._batch_size_counts.items())),
+                'mean_batch_size': round(samples / batches, 3) if batches else 0.0,
+                'largest_batch': self._largest_batch,
+                'mean_queue_wait_ms': round(self._total_wait * 1000.0 / samples, 3) if samples else 0.0,
+                'max_queue_wait_ms': round(self._max_wait * 1000.0, 3),
+                'queue_depth': self._queue.qsize(),
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self._reset_stats()
+
+    def _reset_stats(self):
+        self._batches = 0
+        self._samples = 0
+        self._batch_size_counts = {}
+        self._largest_batch = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            pending = [item]
+            deadline = item.enqueued_at + self.max_wait
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout > 0:
+                        item = self._queue.get(timeout=timeout)
+                    else:
+                        # Past the deadline: still take whatever is already waiting
+                        item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                pending.append(item)
+            self._run_batch(pending)
+
+    def _run_batch(self, pending):
+        import numpy as np
+
+        started = time.monotonic()
+        waits = [started - p.enqueued_at for p in pending]
+        with self._lock:
+            size = len(pending)
+            self._batches += 1
+            self._samples += size
+            self._batch_size_counts[size] = self._batch_size_counts.get(size, 0) + 1
+            self._largest_batch = max(self._largest_batch, size)
+            self._total_wait += sum(waits)
+            self._max_wait = max(self._max_wait, max(waits))
+
+        try:
+            outputs = self.model.predict(np.stack([p.sample for p in pending]))
+        except Exception as e:
+            for p in pending:
+                p.future.set_exception(e)
+            return
+        for p, row in zip(pending, outputs):
+            p.future.set_result(row)
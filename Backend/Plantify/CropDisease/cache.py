@@ -0,0 +1,111 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from django.conf import settings
+
+from .metrics import metrics
+
+
+class PredictionCache:
+    """
+    LRU cache of prediction results keyed by image content and model version.
+
+    Concurrent lookups for the same key share one computation: the first caller
+    runs it, the others wait for its result instead of running the model again.
+    A ``max_entries`` of 0 turns caching and de-duplication off.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max(0, int(max_entries))
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(data, model_version, options=None):
+        # Request options that change the response (e.g. top_k) are part of the key
+        key = f'{hashlib.sha256(data).hexdigest()}:{model_version}'
+        if options:
+            key += ':' + ','.join(f'{name}={value}' for name, value in sorted(options.items()))
+        return key
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached result for ``key``, computing it at most once.
+
+        Returns:
+            tuple: (result, cached) where cached is False only for the caller
+            that actually ran ``compute``
+        """
+        if not self.max_entries:
+            return compute(), False
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key], True
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            return future.result(), True
+
+        try:
+            result = compute()
+        except Exception as e:
+            # Failures are shared with the waiters but never cached
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._entries[key] = result
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            del self._inflight[key]
+        future.set_result(result)
+        return result, False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.coalesced = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_entries': self.max_entries,
+                'entries': len(self._entries),
+                'in_flight': len(self._inflight),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+            }
+
+
+prediction_cache = PredictionCache(settings.CROP_DISEASE_PREDICTION_CACHE_SIZE)
+
+
+@metrics.register_collector
+def collect_cache_metrics():
+    stats = prediction_cache.stats()
+    return [
+        ('plantify_prediction_cache_hits_total', 'counter', 'Predictions answered from the cache.',
+         [({}, stats['hits'])]),
+        ('plantify_prediction_cache_misses_total', 'counter', 'Predictions that ran the model.',
+         [({}, stats['misses'])]),
+        ('plantify_prediction_cache_coalesced_total', 'counter',
+         'Predictions that waited on an identical in-flight inference.', [({}, stats['coalesced'])]),
+        ('plantify_prediction_cache_entries', 'gauge', 'Results currently cached.', [({}, stats['entries'])]),
+    ]
@@ -0,0 +1,83 @@
+import threading
+
+from .crops import restrict_predictions
+from .metrics import metrics, timed_stage
+
+_lock = threading.Lock()
+_predictions = {'light': 0, 'full': 0}
+
+
+class Cascade:
+    """
+    A compact model tried before the full one. Images it predicts with at
+    least ``threshold`` percent confidence keep its answer; only the rest are
+    escalated to the full model. The compact model must take the same input
+    and predict the same classes, in the same order.
+    """
+
+    def __init__(self, model, threshold, batcher=None):
+        self.model = model
+        self.threshold = float(threshold)
+        # Predictions go through the batcher when there is one
+        self.batcher = batcher
+
+    def predict(self, batch):
+        return (self.batcher or self.model).predict(batch)
+
+    def close(self):
+        if self.batcher is not None:
+            self.batcher.close()
+        close = getattr(self.model, 'close', None)
+        if close is not None:
+            close()
+
+
+def predict_cascade(model, batch, cascade=None, classes=None):
+    """
+    Model outputs for ``batch`` and a boolean array marking the rows that were
+    escalated to ``model``. Without a cascade every row is. With ``classes``
+    both tiers' outputs are restricted to those classes (see
+    ``restrict_predictions``) before their confidence is compared.
+    """
+    import numpy as np
+
+    def restrict(predictions):
+        return predictions if classes is None else restrict_predictions(predictions, classes)
+
+    if cascade is None:
+        with timed_stage('model'):
+            return restrict(model.predict(batch)), np.ones(len(batch), dtype=bool)
+    with timed_stage('model_light'):
+        predictions = np.array(restrict(cascade.predict(batch)), dtype='float32')
+    escalated = predictions.max(axis=1) * 100 < cascade.threshold
+    rows = np.flatnonzero(escalated)
+    if len(rows):
+        with timed_stage('model'):
+            predictions[rows] = restrict(model.predict(batch if len(rows) == len(batch) else batch[rows]))
+    with _lock:
+        _predictions['full'] += len(rows)
+        _predictions['light'] += len(batch) - len(rows)
+    return predictions, escalated
+
+
+def cascade_stats():
+    with _lock:
+        light, full = _predictions['light'], _predictions['full']
+    total = light + full
+    return {
+        'light': light,
+        'full': full,
+        'escalation_rate': round(full / total, 4) if total else 0.0,
+    }
+
+
+@metrics.register_collector
+def collect_cascade_metrics():
+    # Per-tier latency is in plantify_predict_stage_seconds{stage="model_light"|"model"}
+    stats = cascade_stats()
+    return [
+        ('plantify_cascade_predictions_total', 'counter', 'Images answered by each tier of the model cascade.',
+         [({'tier': 'light'}, stats['light']), ({'tier': 'full'}, stats['full'])]),
+        ('plantify_cascade_escalation_ratio', 'gauge', 'Share of cascaded images escalated to the full model.',
+         [({}, stats['escalation_rate'])]),
+    ]
@@ -0,0 +1,84 @@
+import re
+
+# Every label in class_indices.json is "<crop>___<disease>"
+CROP_SEPARATOR = '___'
+
+
+class UnknownCrop(ValueError):
+    pass
+
+
+def crop_of(label):
+    return label.split(CROP_SEPARATOR, 1)[0]
+
+
+def normalize_crop(name):
+    # Hints are matched case-insensitively, with spaces standing in for underscores
+    return name.strip().lower().replace(' ', '_')
+
+
+def crop_aliases(crop):
+    # The crop's own name, and without its qualifier: 'Corn_(maize)' is also
+    # 'corn', 'Pepper,_bell' also 'pepper'
+    return {normalize_crop(crop), normalize_crop(re.split(r'_?[(,]', crop)[0])}
+
+
+def crop_groups(class_names):
+    """
+    ``{crop: array of class indices}`` for the labels of every crop, in label
+    order, e.g. ``'Apple'`` -> the indices of the four ``Apple___`` classes.
+    """
+    import numpy as np
+
+    groups = {}
+    for index, label in enumerate(class_names):
+        groups.setdefault(crop_of(label), []).append(index)
+    return {crop: np.array(indices) for crop, indices in groups.items()}
+
+
+def restrict_predictions(predictions, classes):
+    """
+    Zero every class outside ``classes`` and rescale each row to sum to 1
+    again. Rows with nothing left are spread evenly over ``classes``.
+    """
+    import numpy as np
+
+    predictions = np.asarray(predictions, dtype='float32')
+    restricted = np.zeros_like(predictions)
+    restricted[:, classes] = predictions[:, classes]
+    totals = restricted.sum(axis=1, keepdims=True)
+    np.divide(restricted, totals, out=restricted, where=totals > 0)
+    empty = np.flatnonzero(totals[:, 0] <= 0)
+    if len(empty):
+        restricted[np.ix_(empty, classes)] = 1.0 / len(classes)
+    return restricted
+
+
+class CropHead:
+    """
+    A per-crop model that predicts only its crop's classes (one output per
+    class, in label order), widened to full rows over every label, so it can
+    stand in for the full model.
+    """
+
+    def __init__(self, model, classes, num_classes, batcher=None):
+        self.model = model
+        self.classes = classes
+        self.num_classes = num_classes
+        # Predictions go through the batcher when there is one
+        self.batcher = batcher
+
+    def predict(self, batch):
+        import numpy as np
+
+        predictions = (self.batcher or self.model).predict(batch)
+        rows = np.zeros((len(predictions), self.num_classes), dtype='float32')
+        rows[:, self.classes] = predictions
+        return rows
+
+    def close(self):
+        if self.batcher is not None:
+            self.batcher.close()
+        close = getattr(self.model, 'close', None)
+        if close is not None:
+            close()
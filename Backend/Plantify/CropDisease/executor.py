@@ -0,0 +1,82 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .metrics import metrics
+
+
+class BoundedExecutor:
+    """
+    Thread pool that refuses work once ``max_workers`` tasks are running and
+    ``max_queue`` more are waiting, instead of letting the queue grow without limit.
+    """
+
+    def __init__(self, max_workers=4, max_queue=32):
+        self.max_workers = max(1, int(max_workers))
+        self.max_queue = max(0, int(max_queue))
+        self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='crop-disease-inference')
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def try_submit(self, fn, *args, **kwargs):
+        """
+        Run ``fn`` on the pool if there is room for it.
+
+        Returns:
+            Future or None: None when the pool and its queue are full
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            return None
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending += 1
+            self.accepted += 1
+        future.add_done_callback(self._release)
+        return future
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'pending': self._pending,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+            }
+
+    def _release(self, future):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+
+inference_executor = BoundedExecutor(
+    settings.CROP_DISEASE_ASYNC_WORKERS,
+    settings.CROP_DISEASE_ASYNC_QUEUE_SIZE,
+)
+
+
+@metrics.register_collector
+def collect_executor_metrics():
+    stats = inference_executor.stats()
+    return [
+        ('plantify_async_inference_pending', 'gauge', 'Async predictions running or queued.',
+         [({}, stats['pending'])]),
+        ('plantify_async_inference_accepted_total', 'counter', 'Async predictions accepted.',
+         [({}, stats['accepted'])]),
+        ('plantify_async_inference_rejected_total', 'counter', 'Async predictions rejected with 429.',
+         [({}, stats['rejected'])]),
+    ]
@@ -0,0 +1,247 @@
+import atexit
+import io
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# Images in these formats are stored as uploaded; any other is re-encoded as PNG
+STORED_IMAGE_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+
+
+def stored_image(data):
+    """
+    The file name and bytes to store a prediction image as. The extension -
+    and so the type it is served with - comes from the decoded image, never
+    from the name the client uploaded it under.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        extension = STORED_IMAGE_EXTENSIONS.get(image.format)
+        if extension is not None:
+            return f'prediction{extension}', data
+        if image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA', 'I'):
+            image = image.convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+    return 'prediction.png', buffer.getvalue()
+
+
+class _PendingRecord:
+    __slots__ = ('user_id', 'data', 'disease', 'confidence')
+
+    def __init__(self, user_id, data, disease, confidence):
+        self.user_id = user_id
+        self.data = data
+        self.disease = disease
+        self.confidence = confidence
+
+
+class HistoryRecorder:
+    """
+    Write-behind queue for PredictionHistory rows.
+
+    ``record()`` only appends to an in-memory queue, so a prediction never waits
+    on the database or on storage. A background thread drains the queue every
+    ``flush_interval`` seconds (or as soon as ``flush_size`` records are
+    waiting), saves the images and inserts the rows with one ``bulk_create``,
+    adding them to the daily disease counts in the same transaction.
+    Records that arrive while ``max_queue`` are already waiting, or whose image
+    would take the images held for writing past ``max_queue_bytes``, are
+    dropped and counted. ``close()`` - registered with ``atexit`` - writes
+    whatever is left.
+    """
+
+    def __init__(self, flush_size=100, flush_interval=1.0, max_queue=10000, max_queue_bytes=256 * 1024 * 1024):
+        self.flush_size = max(1, int(flush_size))
+        self.flush_interval = max(0.0, float(flush_interval))
+        self._queue = queue.Queue(max(0, int(max_queue)))
+        self.max_queue_bytes = max(0, int(max_queue_bytes))
+        # Image bytes of the records queued or being written
+        self.queued_bytes = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._worker = None
+        self._closed = False
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def record(self, user_id, data, disease, confidence):
+        """Queue one prediction of ``user_id`` for writing. Never blocks; returns False if dropped."""
+        pending = _PendingRecord(user_id, data, disease, confidence)
+        with self._lock:
+            if self._closed:
+                self.dropped += 1
+                return False
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='crop-disease-history', daemon=True)
+                self._worker.start()
+            if self.max_queue_bytes and self.queued_bytes + len(data) > self.max_queue_bytes:
+                self.dropped += 1
+                return False
+            try:
+                self._queue.put_nowait(pending)
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self.queued_bytes += len(data)
+            self.recorded += 1
+        return True
+
+    def flush(self):
+        """Write every queued record now. Returns the number of rows inserted."""
+        with self._flush_lock:
+            written = 0
+            while True:
+                records = self._drain(self.flush_size)
+                if not records:
+                    return written
+                written += self._write(records)
+
+    def close(self):
+        """Stop the background thread after writing everything still queued."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            worker = self._worker
+        if worker is not None:
+            self._queue.put(_STOP)
+            worker.join()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'queued_bytes': self.queued_bytes,
+                'recorded': self.recorded,
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+            }
+
+    def _drain(self, limit):
+        records = []
+        while len(records) < limit:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)  # Leave it for the worker loop
+                break
+            records.append(item)
+        return records
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            # Give the batch until the interval is up to fill
+            records = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(records) < self.flush_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._queue.put(_STOP)
+                    break
+                records.append(item)
+            with self._flush_lock:
+                self._write(records)
+
+    def _write(self, records):
+        from django.contrib.auth import get_user_model
+        from .models import PredictionHistory
+        from .rollups import add_to_rollups
+
+        close_old_connections()
+        try:
+            # Tokens outlive deleted or deactivated accounts; their rows would
+            # fail the whole insert
+            user_ids = {record.user_id for record in records}
+            active = {str(pk) for pk in get_user_model().objects.filter(pk__in=user_ids, is_active=True)
+                      .values_list('pk', flat=True)}
+            rows = []
+            for record in records:
+                if str(record.user_id) not in active:
+                    with self._lock:
+                        self.failed += 1
+                    continue
+                row = PredictionHistory(
+                    user_id=record.user_id, disease=record.disease, confidence=record.confidence,
+                )
+                try:
+                    # Storage I/O happens here, off the request path
+                    name, data = stored_image(record.data)
+                    row.image.save(name, ContentFile(data), save=False)
+                except Exception:
+                    logger.exception('Could not store prediction image of user %s', record.user_id)
+                    with self._lock:
+                        self.failed += 1
+                    continue
+                rows.append(row)
+            try:
+                with transaction.atomic():
+                    PredictionHistory.objects.bulk_create(rows)
+                    add_to_rollups(rows)
+            except Exception:
+                logger.exception('Could not write %d prediction history rows', len(rows))
+                for row in rows:
+                    row.image.delete(save=False)
+                with self._lock:
+                    self.failed += len(rows)
+                return 0
+            with self._lock:
+                self.written += len(rows)
+            return len(rows)
+        finally:
+            with self._lock:
+                self.queued_bytes -= sum(len(record.data) for record in records)
+            close_old_connections()
+
+
+history_recorder = HistoryRecorder(
+    settings.CROP_DISEASE_HISTORY_FLUSH_SIZE,
+    settings.CROP_DISEASE_HISTORY_FLUSH_INTERVAL,
+    settings.CROP_DISEASE_HISTORY_MAX_QUEUE,
+    settings.CROP_DISEASE_HISTORY_MAX_QUEUE_BYTES,
+)
+# Graceful shutdown (e.g. SIGTERM handled by the app server) writes what's left
+atexit.register(history_recorder.close)
+
+
+@metrics.register_collector
+def collect_history_metrics():
+    stats = history_recorder.stats()
+    return [
+        ('plantify_history_queue_depth', 'gauge', 'Prediction history records waiting to be written.',
+         [({}, stats['queued'])]),
+        ('plantify_history_queue_bytes', 'gauge', 'Image bytes held for prediction history records not yet written.',
+         [({}, stats['queued_bytes'])]),
+        ('plantify_history_written_total', 'counter', 'Prediction history rows inserted.',
+         [({}, stats['written'])]),
+        ('plantify_history_dropped_total', 'counter', 'Prediction history records dropped on a full queue.',
+         [({}, stats['dropped'])]),
+        ('plantify_history_failed_total', 'counter', 'Prediction history records that could not be written.',
+         [({}, stats['failed'])]),
+    ]
@@ -0,0 +1,161 @@
+import logging
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+from .compiled import load_keras_model
+
+logger = logging.getLogger(__name__)
+
+# Per-process state of an inference worker
+_worker_model = None
+_worker_barrier = None
+_worker_slots = {}
+
+
+def _init_worker(model_loader, model_path, intra_op_threads, inter_op_threads,
+                 warmup_runs, input_shape, barrier):
+    global _worker_model, _worker_barrier
+    import numpy as np
+
+    if intra_op_threads or inter_op_threads:
+        # Must happen before TensorFlow runs its first op in this process
+        import tensorflow as tf
+        if intra_op_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+    _worker_model = model_loader(model_path)
+    dummy = np.zeros((1,) + tuple(input_shape), dtype='float32')
+    for _ in range(warmup_runs):
+        _worker_model.predict(dummy)
+    _worker_barrier = barrier
+
+
+def _wait_until_warm(timeout):
+    # One of these runs per worker at start-up; the barrier makes sure each
+    # lands on a different process, so every worker has loaded its model
+    if _worker_barrier is not None:
+        _worker_barrier.wait(timeout)
+    return multiprocessing.current_process().pid
+
+
+def _predict_slot(slot_name, count, input_shape):
+    import numpy as np
+
+    shm = _worker_slots.get(slot_name)
+    if shm is None:
+        shm = _worker_slots[slot_name] = shared_memory.SharedMemory(name=slot_name)
+    batch = np.ndarray((count,) + tuple(input_shape), dtype='float32', buffer=shm.buf)
+    return np.asarray(_worker_model.predict(batch))
+
+
+class ProcessInferencePool:
+    """
+    Runs ``predict(batch)`` on a pool of pre-warmed inference processes.
+
+    Every worker loads its own copy of the model at start-up. Input tensors are
+    copied into a fixed set of shared memory slots and only the slot name goes
+    through the pipe, so images are never pickled; the (small) probability
+    arrays come back the normal way. Batches larger than ``slot_capacity`` are
+    split across several slots.
+    """
+
+    def __init__(self, model_path, processes=4, intra_op_threads=0, inter_op_threads=0,
+                 warmup_runs=1, input_shape=(224, 224, 3), slot_capacity=16,
+                 model_loader=load_keras_model, start_timeout=600):
+        import numpy as np
+
+        self.model_path = model_path
+        self.processes = max(1, int(processes))
+        self.intra_op_threads = int(intra_op_threads)
+        self.inter_op_threads = int(inter_op_threads)
+        self.warmup_runs = int(warmup_runs)
+        self.input_shape = tuple(input_shape)
+        self.slot_capacity = max(1, int(slot_capacity))
+        self.model_loader = model_loader
+        self.start_timeout = start_timeout
+        self._context = multiprocessing.get_context('spawn')
+        self._executor = None
+        self._lock = threading.Lock()
+
+        # Two slots per process keeps every worker busy while the next batch is copied in
+        slot_bytes = self.slot_capacity * int(np.prod(self.input_shape)) * 4
+        self._slots = [shared_memory.SharedMemory(create=True, size=slot_bytes)
+                       for _ in range(self.processes * 2)]
+        self._free_slots = queue.Queue()
+        for slot in self._slots:
+            self._free_slots.put(slot)
+
+    def start(self):
+        """Spawn the workers and block until every one has loaded and warmed its model."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._spawn()
+        return self
+
+    def predict(self, batch):
+        import numpy as np
+
+        batch = np.asarray(batch, dtype='float32')
+        executor = self._executor or self.start()._executor
+        try:
+            futures = [
+                self._submit(executor, batch[offset:offset + self.slot_capacity])
+                for offset in range(0, len(batch), self.slot_capacity)
+            ]
+            return np.concatenate([future.result() for future in futures])
+        except BrokenProcessPool:
+            self._replace_broken(executor)
+            raise
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        for slot in self._slots:
+            slot.close()
+            slot.unlink()
+        self._slots = []
+
+    def _submit(self, executor, chunk):
+        import numpy as np
+
+        slot = self._free_slots.get()
+        try:
+            view = np.ndarray(chunk.shape, dtype='float32', buffer=slot.buf)
+            view[...] = chunk
+            del view
+            future = executor.submit(_predict_slot, slot.name, len(chunk), self.input_shape)
+        except Exception:
+            self._free_slots.put(slot)
+            raise
+        future.add_done_callback(lambda _: self._free_slots.put(slot))
+        return future
+
+    def _spawn(self):
+        barrier = self._context.Barrier(self.processes)
+        executor = ProcessPoolExecutor(
+            self.processes,
+            mp_context=self._context,
+            initializer=_init_worker,
+            initargs=(self.model_loader, self.model_path, self.intra_op_threads,
+                      self.inter_op_threads, self.warmup_runs, self.input_shape, barrier),
+        )
+        futures = [executor.submit(_wait_until_warm, self.start_timeout) for _ in range(self.processes)]
+        pids = [future.result(self.start_timeout) for future in futures]
+        logger.info('Started %d inference processes: %s', len(set(pids)), pids)
+        return executor
+
+    def _replace_broken(self, executor):
+        # A worker died (e.g. OOM-killed); start a fresh pool for the next call
+        with self._lock:
+            if self._executor is executor:
+                logger.error('Inference process pool broke, restarting it')
+                executor.shutdown(wait=False)
+                self._executor = None
@@ -0,0 +1,197 @@
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from CropDisease.cache import prediction_cache
+from CropDisease.compiled import CompiledModel
+from CropDisease.postprocess import postprocess_predictions
+from CropDisease.registry import registry
+from CropDisease.views import load_and_preprocess_image
+
+
+class NumpyStubModel:
+    """Tiny stand-in used when TensorFlow isn't installed: pooled pixels through a random projection."""
+
+    def __init__(self, num_classes, seed=0):
+        import numpy as np
+
+        self.weights = np.random.default_rng(seed).standard_normal((3, num_classes)).astype('float32')
+
+    def predict(self, batch):
+        import numpy as np
+
+        logits = batch.mean(axis=(1, 2)) @ self.weights
+        exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return exp / exp.sum(axis=1, keepdims=True)
+
+
+def build_stub_model(num_classes, input_shape=(224, 224, 3)):
+    """A few-KB Keras model with the production input and output shapes, or a NumPy stand-in."""
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return NumpyStubModel(num_classes)
+
+    inputs = tf.keras.Input(shape=input_shape)
+    x = tf.keras.layers.Conv2D(8, 3, strides=4, activation='relu')(inputs)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    outputs = tf.keras.layers.Dense(num_classes, activation='softmax')(x)
+    return tf.keras.Model(inputs, outputs)
+
+
+def make_jpeg(width, height, seed=0):
+    """Synthetic leaf-coloured photo with noise, so JPEG decode does realistic work."""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    pixels = rng.normal((60, 140, 50), 35, size=(height, width, 3)).clip(0, 255).astype('uint8')
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def summarize(latencies, wall_seconds):
+    import numpy as np
+
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000.0, [50, 95, 99])
+    return {
+        'count': len(latencies),
+        'p50_ms': round(float(p50), 3),
+        'p95_ms': round(float(p95), 3),
+        'p99_ms': round(float(p99), 3),
+        'throughput_per_s': round(len(latencies) / wall_seconds, 2) if wall_seconds else None,
+    }
+
+
+def run_timed(fn, iterations, concurrency):
+    """Call ``fn`` ``iterations`` times from ``concurrency`` threads; return per-call latencies and wall time."""
+
+    def timed(_):
+        started = time.perf_counter()
+        fn()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(timed, range(iterations)))
+    return latencies, time.perf_counter() - started
+
+
+def parse_list(value, cast):
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+
+def parse_resolution(value):
+    width, _, height = value.lower().partition('x')
+    return int(width), int(height)
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the crop disease hot path: image decode/preprocessing, model call, '
+        'post-processing and the full predict endpoint, at several image sizes and concurrency levels.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resolutions', default='640x480,1600x1200,4000x3000',
+                            help='Comma-separated WIDTHxHEIGHT of the synthetic JPEGs')
+        parser.add_argument('--concurrency', default='1,4,8',
+                            help='Comma-separated numbers of concurrent callers')
+        parser.add_argument('--iterations', type=int, default=20,
+                            help='Calls per stage, resolution and concurrency level')
+        parser.add_argument('--stages', default='decode,model,keras_predict,postprocess,endpoint',
+                            help='Comma-separated subset of decode, model, keras_predict, postprocess, '
+                                 'endpoint. keras_predict times plain model.predict on the same input '
+                                 'as model, for comparison with the compiled inference function.')
+        parser.add_argument('--decode-modes', default='exact,fast',
+                            help='Comma-separated decode paths to compare: exact, fast')
+        parser.add_argument('--stub-model', action='store_true',
+                            help='Use a tiny stub model instead of loading the VGG16 weights')
+        parser.add_argument('--json', action='store_true', help='Print results as JSON lines')
+
+    def handle(self, *args, **options):
+        try:
+            resolutions = parse_list(options['resolutions'], parse_resolution)
+            concurrency_levels = parse_list(options['concurrency'], int)
+        except ValueError:
+            raise CommandError('Invalid --resolutions or --concurrency')
+        stages = parse_list(options['stages'], str)
+        decode_modes = parse_list(options['decode_modes'], str)
+        iterations = options['iterations']
+        self.as_json = options['json']
+
+        if options['stub_model']:
+            num_classes = len(registry.read_class_indices())
+            stub = build_stub_model(num_classes)
+            if not isinstance(stub, NumpyStubModel):
+                stub = registry.wrap_model(stub)
+            registry.set_model(stub, version='benchmark-stub')
+        else:
+            registry.load()
+
+        images = {size: make_jpeg(*size) for size in resolutions}
+        tensor = load_and_preprocess_image(images[resolutions[0]])
+        predictions = registry.model.predict(tensor)
+
+        for concurrency in concurrency_levels:
+            if 'decode' in stages:
+                for mode in decode_modes:
+                    for size, data in images.items():
+                        self.measure('decode', concurrency, iterations,
+                                     lambda: load_and_preprocess_image(data, fast=mode == 'fast'),
+                                     resolution='%dx%d' % size, decode=mode)
+            if 'model' in stages:
+                self.measure('model', concurrency, iterations, lambda: registry.model.predict(tensor))
+            if 'keras_predict' in stages and isinstance(registry.model, CompiledModel):
+                keras_model = registry.model.model
+                self.measure('keras_predict', concurrency, iterations,
+                             lambda: keras_model.predict(tensor, verbose=0))
+            if 'postprocess' in stages:
+                self.measure('postprocess', concurrency, iterations,
+                             lambda: postprocess_predictions(predictions, registry.class_names, top_k=5))
+            if 'endpoint' in stages:
+                for size, data in images.items():
+                    self.measure_endpoint(data, concurrency, iterations, resolution='%dx%d' % size)
+
+    def measure(self, stage, concurrency, iterations, fn, **labels):
+        fn()  # Untimed first call so lazy initialisation isn't counted
+        latencies, wall = run_timed(fn, iterations, concurrency)
+        self.report(dict({'stage': stage, 'concurrency': concurrency}, **labels), summarize(latencies, wall))
+
+    def measure_endpoint(self, data, concurrency, iterations, **labels):
+        url = reverse('predict_disease')
+        errors = []
+
+        def post():
+            upload = SimpleUploadedFile('leaf.jpg', data, content_type='image/jpeg')
+            response = Client().post(url, {'image': upload})
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+        # Every request must reach the model, so the prediction cache is bypassed
+        cache_size = prediction_cache.max_entries
+        prediction_cache.max_entries = 0
+        try:
+            with override_settings(ALLOWED_HOSTS=['testserver']):
+                self.measure('endpoint', concurrency, iterations, post, **labels)
+        finally:
+            prediction_cache.max_entries = cache_size
+        if errors:
+            self.stderr.write(f'{len(errors)} endpoint requests failed: {sorted(set(errors))}')
+
+    def report(self, labels, summary):
+        if self.as_json:
+            self.stdout.write(json.dumps(dict(labels, **summary)))
+            return
+        label = ' '.join(f'{name}={value}' for name, value in labels.items())
+        self.stdout.write(
+            f"{label:<55} p50={summary['p50_ms']:>9.2f}ms p95={summary['p95_ms']:>9.2f}ms "
+            f"p99={summary['p99_ms']:>9.2f}ms {summary['throughput_per_s']:>9.1f}/s"
+        )
@@ -0,0 +1,189 @@
+import collections
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from CropDisease.cascade import Cascade, predict_cascade
+from CropDisease.postprocess import postprocess_predictions
+from CropDisease.registry import registry
+from CropDisease.scan import decode_chunk, iter_image_files
+
+from .benchmark_inference import NumpyStubModel, build_stub_model
+
+CSV_FIELDS = ('path', 'disease_name', 'confidence', 'top_k', 'error')
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_checkpoint(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path, state):
+    # Written to a temporary file and renamed, so a crash never leaves half a checkpoint
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(state, f)
+    os.replace(temporary, path)
+
+
+class Command(BaseCommand):
+    help = (
+        'Predict the disease of every image under a directory tree, writing one CSV row or '
+        'JSON line per image. Images are decoded in parallel worker processes and sent to the '
+        'model in batches. Progress is checkpointed after every batch so an interrupted scan '
+        'can be continued with --resume.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Directory to scan recursively')
+        parser.add_argument('output', help='Result file (.csv or .jsonl)')
+        parser.add_argument('--format', choices=('csv', 'jsonl'),
+                            help='Output format; defaults to the output file extension')
+        parser.add_argument('--batch-size', type=int, default=32, help='Images per model call')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Decode processes; 0 decodes in this process')
+        parser.add_argument('--top-k', type=int, help='Also report the k most likely diseases')
+        parser.add_argument('--fast-decode', action='store_true', default=settings.CROP_DISEASE_FAST_DECODE,
+                            help='Decode JPEGs at reduced scale (see CROP_DISEASE_FAST_DECODE)')
+        parser.add_argument('--checkpoint', help='Checkpoint file; defaults to OUTPUT.checkpoint')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue after the last checkpointed image instead of starting over')
+        parser.add_argument('--progress-every', type=float, default=10.0,
+                            help='Seconds between progress reports')
+        parser.add_argument('--stub-model', action='store_true',
+                            help='Use a tiny stub model instead of loading the VGG16 weights')
+
+    def handle(self, *args, **options):
+        root = os.path.abspath(options['directory'])
+        if not os.path.isdir(root):
+            raise CommandError(f'{root} is not a directory')
+        output = options['output']
+        output_format = options['format'] or ('csv' if output.lower().endswith('.csv') else 'jsonl')
+        checkpoint_path = options['checkpoint'] or output + '.checkpoint'
+        batch_size = max(1, options['batch_size'])
+        top_k = options['top_k']
+
+        state = read_checkpoint(checkpoint_path) if options['resume'] else None
+        if state is not None and (state['directory'] != root or state['format'] != output_format):
+            raise CommandError(f'{checkpoint_path} belongs to a scan of {state["directory"]} '
+                               f'({state["format"]}); run without --resume to start over')
+        if state is None:
+            state = {'directory': root, 'format': output_format, 'done': 0, 'errors': 0,
+                     'last_path': None, 'output_bytes': 0}
+
+        model, class_names, cascade = self.load_model(options['stub_model'])
+
+        paths = iter_image_files(root)
+        if state['done']:
+            skipped = list(itertools.islice(paths, state['done']))
+            if len(skipped) != state['done'] or skipped[-1] != state['last_path']:
+                raise CommandError(f'{root} has changed since the checkpoint was written; '
+                                   'run without --resume to start over')
+
+        # Drop anything written after the last checkpoint (e.g. half a batch before a crash)
+        with open(output, 'ab') as f:
+            f.truncate(state['output_bytes'])
+
+        with open(output, 'a', newline='') as out:
+            writer = csv.DictWriter(out, CSV_FIELDS) if output_format == 'csv' else None
+            if writer is not None and not state['output_bytes']:
+                writer.writeheader()
+
+            started = last_report = time.perf_counter()
+            scanned = 0
+            chunks = chunked(paths, batch_size)
+            for chunk, (batch, errors) in self.decode(root, chunks, options['workers'], options['fast_decode']):
+                for record in self.predict(model, class_names, cascade, chunk, batch, errors, top_k):
+                    if writer is not None:
+                        if 'top_k' in record:
+                            record['top_k'] = json.dumps(record['top_k'])
+                        writer.writerow(record)
+                    else:
+                        out.write(json.dumps(record) + '\n')
+                out.flush()
+
+                scanned += len(chunk)
+                state['done'] += len(chunk)
+                state['errors'] += len(errors)
+                state['last_path'] = chunk[-1]
+                state['output_bytes'] = os.fstat(out.fileno()).st_size
+                write_checkpoint(checkpoint_path, state)
+
+                now = time.perf_counter()
+                if now - last_report >= options['progress_every']:
+                    self.report(state, scanned, now - started)
+                    last_report = now
+
+        self.report(state, scanned, time.perf_counter() - started, final=True)
+
+    def load_model(self, stub):
+        if stub:
+            model = build_stub_model(len(registry.read_class_indices()))
+            if not isinstance(model, NumpyStubModel):
+                model = registry.wrap_model(model)
+            registry.set_model(model, version='bulk-scan-stub')
+        else:
+            registry.load()
+        # Straight to the models: batches are already as large as we want them
+        cascade = registry.cascade
+        if cascade is not None:
+            cascade = Cascade(cascade.model, cascade.threshold)
+        return registry.model, registry.class_names, cascade
+
+    def decode(self, root, chunks, workers, fast):
+        """Yield (chunk, (batch, errors)) in input order, decoding ahead on ``workers`` processes."""
+        target_size = registry.input_shape[1::-1]
+        if workers <= 0:
+            for chunk in chunks:
+                yield chunk, decode_chunk(root, chunk, target_size, fast)
+            return
+
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            # Keep every worker busy without decoding the whole tree into memory
+            in_flight = collections.deque()
+            for chunk in chunks:
+                in_flight.append((chunk, pool.submit(decode_chunk, root, chunk, target_size, fast)))
+                if len(in_flight) >= 2 * workers:
+                    chunk, future = in_flight.popleft()
+                    yield chunk, future.result()
+            while in_flight:
+                chunk, future = in_flight.popleft()
+                yield chunk, future.result()
+
+    def predict(self, model, class_names, cascade, chunk, batch, errors, top_k):
+        decoded = [i for i in range(len(chunk)) if i not in errors]
+        results = {}
+        if decoded:
+            predictions = predict_cascade(model, batch if len(decoded) == len(chunk) else batch[decoded], cascade)[0]
+            results = dict(zip(decoded, postprocess_predictions(predictions, class_names, top_k)))
+        for i, path in enumerate(chunk):
+            if i in errors:
+                yield {'path': path, 'error': errors[i]}
+            else:
+                yield dict({'path': path}, **results[i])
+
+    def report(self, state, scanned, seconds, final=False):
+        rate = scanned / seconds if seconds else 0.0
+        prefix = 'Scanned' if final else 'Progress:'
+        self.stdout.write(f"{prefix} {state['done']} images ({state['errors']} unreadable), "
+                          f'{scanned} this run in {seconds:.1f}s, {rate:.1f} images/s')
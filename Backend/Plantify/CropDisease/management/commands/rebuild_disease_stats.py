@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from CropDisease.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the daily disease count rollups from PredictionHistory, e.g. to backfill '
+        'them for existing history or to repair drift.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rollup rows per INSERT')
+
+    def handle(self, *args, **options):
+        global_rows, user_rows = rebuild_rollups(options['batch_size'])
+        self.stdout.write(f'Rebuilt {global_rows} global and {user_rows} per-user daily disease counts')
@@ -0,0 +1,183 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Stage timings of the request being handled, if it asked for them
+_request_timings = contextvars.ContextVar('crop_disease_request_timings', default=None)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative-bucket histogram, rendered in the Prometheus text format."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # One count per bucket plus +Inf, then the sum
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(labels + [("le", le)])} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(values[-1])}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Histograms owned by this module plus collectors that report other objects'
+    counters (batcher, cache, executor) at scrape time.
+    """
+
+    def __init__(self):
+        self.histograms = []
+        self.collectors = []
+
+    def histogram(self, *args, **kwargs):
+        histogram = Histogram(*args, **kwargs)
+        self.histograms.append(histogram)
+        return histogram
+
+    def register_collector(self, collector):
+        """
+        ``collector()`` returns (name, type, documentation, samples) tuples where
+        samples is a list of (labels dict, value).
+        """
+        self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        lines = []
+        for histogram in self.histograms:
+            lines.extend(histogram.render())
+        for collector in self.collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f'# HELP {name} {documentation}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram(
+    'plantify_predict_stage_seconds',
+    'Time spent in each stage of a crop disease prediction.',
+    labelnames=('stage',),
+)
+REQUEST_SECONDS = metrics.histogram(
+    'plantify_predict_request_seconds',
+    'End-to-end latency of crop disease prediction views.',
+    labelnames=('view', 'status'),
+)
+
+
+class RequestTimings:
+    """Stage durations recorded while one request is handled."""
+
+    def __init__(self):
+        self.stages = []
+        self.started = time.perf_counter()
+
+    def add(self, name, seconds, description=None):
+        self.stages.append((name, seconds, description))
+
+    def server_timing(self):
+        # Durations of a repeated stage are reported once, summed
+        merged = {}
+        for name, seconds, description in self.stages:
+            previous = merged.get(name)
+            merged[name] = (seconds + (previous[0] if previous else 0.0), description)
+        parts = []
+        for name, (seconds, description) in merged.items():
+            part = f'{name};dur={seconds * 1000.0:.2f}'
+            if description:
+                part += f';desc="{description}"'
+            parts.append(part)
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000.0:.2f}')
+        return ', '.join(parts)
+
+
+@contextmanager
+def track_request(view):
+    """
+    Collect stage timings for the duration of a view. Sets the Server-Timing
+    header on ``timings.response`` if the view assigns one.
+    """
+    timings = RequestTimings()
+    timings.response = None
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+        response = timings.response
+        status = response.status_code if response is not None else 500
+        REQUEST_SECONDS.observe(time.perf_counter() - timings.started, view=view, status=status)
+        if response is not None:
+            response['Server-Timing'] = timings.server_timing()
+
+
+@contextmanager
+def timed_stage(name):
+    """Time a block into the stage histogram and the current request's Server-Timing."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.add(name, elapsed)
+
+
+def annotate_request(name, description):
+    """Add a zero-duration marker (e.g. a cache hit) to the current request's Server-Timing."""
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.add(name, 0.0, description)
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-18 07:18
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CropDisease', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='predictionhistory',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='history_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='predictionhistory',
+            index=models.Index(fields=['user', 'disease', '-created_at', '-id'], name='history_user_disease_idx'),
+        ),
+    ]
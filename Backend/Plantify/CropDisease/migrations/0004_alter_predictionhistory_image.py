@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-18 07:22
+
+import Account.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CropDisease', '0003_diseasedailycount_userdiseasedailycount'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='predictionhistory',
+            name='image',
+            field=models.ImageField(storage=Account.storage.ContentAddressedStorage(), upload_to='prediction_images/'),
+        ),
+    ]
@@ -1,12 +1,52 @@
 from django.db import models
 from django.conf import settings
+from Account.storage import content_addressed_storage
 
 class PredictionHistory(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    image = models.ImageField(upload_to='prediction_images/')
+    image = models.ImageField(upload_to='prediction_images/', storage=content_addressed_storage)
     disease = models.CharField(max_length=255)
     confidence = models.FloatField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # Serve the newest-first history pages (optionally for one disease) as
+        # index range scans; id breaks ties between equal timestamps
+        indexes = [
+            models.Index(fields=['user', '-created_at', '-id'], name='history_user_created_idx'),
+            models.Index(fields=['user', 'disease', '-created_at', '-id'], name='history_user_disease_idx'),
+        ]
+
     def __str__(self):
         return f"{self.user.email} - {self.disease} ({self.created_at})"
+
+
+# Daily prediction counts per disease, kept up to date by the history writer
+# (see rollups.py) so dashboards never aggregate PredictionHistory itself
+class DiseaseDailyCount(models.Model):
+    day = models.DateField()
+    disease = models.CharField(max_length=255)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'disease'], name='disease_daily_count_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} - {self.disease}: {self.count}"
+
+
+class UserDiseaseDailyCount(models.Model):
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    day = models.DateField()
+    disease = models.CharField(max_length=255)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day', 'disease'], name='user_disease_daily_count_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.email} - {self.day} - {self.disease}: {self.count}"
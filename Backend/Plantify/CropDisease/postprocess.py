@@ -0,0 +1,67 @@
+def class_names_from_indices(class_indices):
+    """
+    Turn the ``{"0": "Apple___Apple_scab", ...}`` mapping from class_indices.json
+    into an index-aligned array, so labels are looked up by fancy indexing.
+    """
+    import numpy as np
+
+    return np.array([class_indices[str(i)] for i in range(len(class_indices))], dtype=object)
+
+
+def postprocess_predictions(predictions, class_names, top_k=None, min_confidence=None, classes=None):
+    """
+    Convert a batch of model outputs into API results.
+
+    Every result has the top-1 ``disease_name`` and ``confidence`` (a percentage).
+    With ``top_k`` it also gets a ``top_k`` list of the k most likely classes,
+    best first, leaving out any below ``min_confidence`` percent. The top-k
+    selection runs on the whole batch at once with ``argpartition``.
+
+    Args:
+        predictions: array of shape (batch, classes)
+        class_names: index-aligned label array from ``class_names_from_indices``
+        top_k (int, optional): number of classes to list per image
+        min_confidence (float, optional): cutoff in percent for the top-k list
+        classes (array, optional): indices of the only classes that may be
+            returned (e.g. a crop's), capping k at their number
+
+    Returns:
+        list: one result dict per row of ``predictions``
+    """
+    import numpy as np
+
+    predictions = np.asarray(predictions)
+    if classes is not None:
+        predictions = predictions[:, classes]
+        class_names = class_names[classes]
+    num_classes = predictions.shape[1]
+    k = min(max(int(top_k or 1), 1), num_classes)
+
+    if k < num_classes:
+        indices = np.argpartition(predictions, num_classes - k, axis=1)[:, num_classes - k:]
+    else:
+        indices = np.broadcast_to(np.arange(num_classes), predictions.shape)
+    # Ties go to the lowest class index, as with argmax
+    indices = np.sort(indices, axis=1)
+    scores = np.take_along_axis(predictions, indices, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    indices = np.take_along_axis(indices, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    names = class_names[indices]
+
+    results = []
+    for row_names, row_scores in zip(names.tolist(), scores.tolist()):
+        confidences = [round(score * 100, 2) for score in row_scores]
+        # Include confidence score in the prediction
+        result = {
+            'disease_name': row_names[0],
+            'confidence': confidences[0],
+        }
+        if top_k:
+            result['top_k'] = [
+                {'disease_name': name, 'confidence': confidence}
+                for name, confidence in zip(row_names, confidences)
+                if min_confidence is None or confidence >= min_confidence
+            ]
+        results.append(result)
+    return results
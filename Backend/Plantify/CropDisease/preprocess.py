@@ -0,0 +1,45 @@
+import io
+
+from PIL import Image
+
+from .metrics import timed_stage
+
+# Image decoding shared by the views and bulk_scan's decode workers. Those are
+# spawned processes without Django, so settings are only read when needed.
+
+
+def load_and_preprocess_image(image, target_size=(224, 224), fast=None, out=None):
+    # Accepts a path, raw bytes or any file-like object (e.g. an UploadedFile),
+    # so uploads are decoded straight from memory.
+    # With fast decoding, JPEGs are decoded by libjpeg at 1/2, 1/4 or 1/8 scale
+    # (never below target_size) instead of at full resolution.
+    # The normalized pixels are written into `out` when given (e.g. one row of a
+    # batch tensor), otherwise into a new (1, height, width, 3) float32 array.
+    import numpy as np
+
+    if fast is None:
+        from django.conf import settings
+
+        fast = settings.CROP_DISEASE_FAST_DECODE
+    width, height = target_size
+    try:
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            image = io.BytesIO(image)
+        elif hasattr(image, 'seek'):
+            image.seek(0)
+        with timed_stage('decode'):
+            img = Image.open(image)
+            if fast:
+                img.draft('RGB', target_size)
+            img = img.convert('RGB')  # Ensure image is in RGB format
+        with timed_stage('resize'):
+            img = img.resize(target_size, reducing_gap=3.0 if fast else None)
+
+        with timed_stage('normalize'):
+            if out is None:
+                out = np.empty((1, height, width, 3), dtype='float32')
+            # Scale to [0, 1] in a single pass without intermediate arrays
+            np.divide(np.asarray(img), np.float32(255.0), out=out.reshape(height, width, 3))
+        return out
+    except Exception as e:
+        raise ValueError(f"Error processing image: {str(e)}")
@@ -0,0 +1,544 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+from django.conf import settings
+
+from .batching import MicroBatcher
+from .cascade import Cascade
+from .compiled import compile_model, load_keras_model
+from .crops import CropHead, UnknownCrop, crop_aliases, crop_groups, normalize_crop
+from .metrics import metrics
+from .postprocess import class_names_from_indices
+
+logger = logging.getLogger(__name__)
+
+NOT_LOADED = 'not_loaded'
+LOADING = 'loading'
+WARMING_UP = 'warming_up'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class ModelVersion:
+    """
+    One loaded model with the class indices it goes with, a batcher of its
+    own, optionally a Cascade tried before it and per-crop models
+    (``crop_heads``). Requests hold a version (see ``ModelRegistry.acquire()``)
+    while they use it, so one that has been swapped out is only closed once the
+    last request using it is done.
+    """
+
+    def __init__(self, model, class_indices, version, batcher, cascade=None):
+        self.model = model
+        self.class_indices = class_indices
+        self.class_names = class_names_from_indices(class_indices)
+        self.version = version
+        self.batcher = batcher
+        self.cascade = cascade
+        self.crop_groups = crop_groups(self.class_names)
+        self.crop_heads = {}
+        self._crops_by_name = {alias: crop for crop in self.crop_groups for alias in crop_aliases(crop)}
+        self.loaded_at = time.time()
+        self._lock = threading.Lock()
+        self._users = 0
+        self._retired = False
+
+    def resolve_crop(self, hint):
+        """The crop named by a user's hint (None without one); UnknownCrop if there is no such crop."""
+        if not hint:
+            return None
+        crop = self._crops_by_name.get(normalize_crop(hint))
+        if crop is None:
+            raise UnknownCrop(f"Unknown crop '{hint}', expected one of: {', '.join(sorted(self.crop_groups))}")
+        return crop
+
+    def route(self, crop):
+        """
+        (crop head, classes) for predicting ``crop``: its own model, or None if
+        none is registered and the full model's output is to be restricted to
+        the crop's classes. Results are only ever drawn from ``classes``.
+        """
+        if crop is None:
+            return None, None
+        return self.crop_heads.get(crop), self.crop_groups[crop]
+
+    def acquire(self):
+        with self._lock:
+            self._users += 1
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            closing = self._retired and self._users == 0
+        if closing:
+            self._close_in_background()
+
+    def retire(self):
+        """Close this version once nothing uses it any more."""
+        with self._lock:
+            self._retired = True
+            closing = self._users == 0
+        if closing:
+            self._close_in_background()
+
+    def close(self):
+        self.batcher.close()
+        # Process pools hold worker processes and shared memory
+        close = getattr(self.model, 'close', None)
+        if close is not None:
+            close()
+        if self.cascade is not None:
+            self.cascade.close()
+        for head in self.crop_heads.values():
+            head.close()
+
+    def _close_in_background(self):
+        threading.Thread(target=self.close, name='crop-disease-model-retire', daemon=True).start()
+
+
+class ModelRegistry:
+    """
+    Owns the crop disease model, its class indices and the batcher in front of
+    it, as the current ModelVersion.
+
+    Nothing is loaded until the first call to ``load()`` (made by the first
+    prediction, the readiness endpoint or the app startup hook). Loading runs
+    ``warmup_runs`` dummy inferences before the registry reports ready, so the
+    first real request doesn't pay for graph tracing.
+
+    ``reload()`` loads the model files again as a new version and warms it up
+    in the background while the current version keeps serving, then swaps it
+    in. Requests that started on the old version finish on it.
+
+    With ``light_model_path`` a compact model is loaded alongside and tried
+    first; images it is less than ``cascade_threshold`` percent sure about are
+    escalated to the full model.
+
+    Models in ``crop_models_dir`` named after a crop (``Apple.h5``,
+    ``Corn_(maize).keras``, ...) and predicting only that crop's classes, in
+    label order, answer requests with a hint for that crop. They are loaded in
+    this process, so loading refuses them with ``inference_mode='process'``,
+    where each would need a worker pool of its own.
+    """
+
+    def __init__(self, model_path, class_indices_path, warmup_runs=1,
+                 input_shape=(224, 224, 3), batch_max_size=16, batch_max_wait_ms=5,
+                 version=None, inference_mode='thread', pool_options=None,
+                 compiled=True, jit_compile=False, light_model_path=None, cascade_threshold=90.0,
+                 crop_models_dir=None):
+        self.model_path = model_path
+        self.class_indices_path = class_indices_path
+        self.light_model_path = light_model_path
+        self.cascade_threshold = cascade_threshold
+        self.crop_models_dir = crop_models_dir
+        self.configured_version = version
+        self.inference_mode = inference_mode
+        self.pool_options = pool_options or {}
+        self.compiled = compiled
+        self.jit_compile = jit_compile
+        self.warmup_runs = max(0, int(warmup_runs))
+        self.input_shape = tuple(input_shape)
+        self.batch_max_size = max(1, int(batch_max_size))
+        self.batch_max_wait_ms = batch_max_wait_ms
+        self.current = None
+        self.state = NOT_LOADED
+        self.error = None
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.reloading = False
+        self.reload_error = None
+        self.reloads = 0
+        self._lock = threading.Lock()  # Held while loading
+        self._swap_lock = threading.Lock()  # Guards current and reloading
+        self._loader = None
+        self._watcher = None
+        self._closed = threading.Event()
+        self._files_signature = None
+
+    # The parts of the current version, for callers that use them one at a time
+    @property
+    def model(self):
+        return self.current.model if self.current else None
+
+    @property
+    def class_indices(self):
+        return self.current.class_indices if self.current else None
+
+    @property
+    def class_names(self):
+        return self.current.class_names if self.current else None
+
+    @property
+    def version(self):
+        return self.current.version if self.current else None
+
+    @property
+    def batcher(self):
+        return self.current.batcher if self.current else None
+
+    @property
+    def cascade(self):
+        return self.current.cascade if self.current else None
+
+    def is_ready(self):
+        return self.state == READY
+
+    def load(self):
+        """Load and warm up the model if that hasn't happened yet. Blocks until ready."""
+        if self.state == READY:
+            return self
+        with self._lock:
+            if self.state != READY:
+                self._load()
+        return self
+
+    @contextlib.contextmanager
+    def acquire(self):
+        """
+        Load the model if need be and hold the current ModelVersion until the
+        block exits, even if another version is swapped in meanwhile.
+        """
+        self.load()
+        with self._swap_lock:
+            active = self.current
+            active.acquire()
+        try:
+            yield active
+        finally:
+            active.release()
+
+    def load_in_background(self):
+        """Start loading on a background thread, for startup hooks and readiness probes."""
+        with self._lock:
+            if self.state in (READY, LOADING, WARMING_UP) or self._loader is not None:
+                return
+            self._loader = threading.Thread(target=self._load_quietly, name='crop-disease-model-loader', daemon=True)
+            self._loader.start()
+
+    def reload(self, wait=False):
+        """
+        Load the model and class indices files again as a new version, warm it
+        up and swap it in. Runs on a background thread unless ``wait``, in which
+        case errors are raised. Returns False if a reload is already running.
+        """
+        with self._swap_lock:
+            if self.reloading:
+                return False
+            self.reloading = True
+        if wait:
+            self._reload(raise_errors=True)
+        else:
+            threading.Thread(target=self._reload, name='crop-disease-model-reloader', daemon=True).start()
+        return True
+
+    def watch(self, interval):
+        """Reload whenever the model or class indices file changes, checking every ``interval`` seconds."""
+        with self._swap_lock:
+            if self._watcher is not None:
+                return
+            self._closed.clear()
+            self._watcher = threading.Thread(
+                target=self._watch, args=(interval,), name='crop-disease-model-watcher', daemon=True
+            )
+            self._watcher.start()
+
+    def set_model(self, model, class_indices=None, version='custom', light_model=None, crop_models=None):
+        """Install an already-built model (used by tests and benchmarks) and warm it up."""
+        with self._lock:
+            if class_indices is None:
+                class_indices = self.read_class_indices()
+            self._install(model, class_indices, version, light_model, crop_models)
+
+    def close(self):
+        """Retire the current version and stop watching the files."""
+        self._closed.set()
+        with self._swap_lock:
+            old, self.current = self.current, None
+            self._watcher = None
+        self.state = NOT_LOADED
+        if old is not None:
+            old.retire()
+
+    def status(self):
+        return {
+            'ready': self.is_ready(),
+            'state': self.state,
+            'version': self.version,
+            'error': self.error,
+            'load_seconds': self.load_seconds,
+            'warmup_seconds': self.warmup_seconds,
+            'warmup_runs': self.warmup_runs,
+            'reloading': self.reloading,
+            'reload_error': self.reload_error,
+            'reloads': self.reloads,
+        }
+
+    def _load_quietly(self):
+        try:
+            self.load()
+        except Exception:
+            logger.exception('Background model load failed')
+        finally:
+            self._loader = None
+
+    def _load(self):
+        self.state = LOADING
+        self.error = None
+        try:
+            started = time.perf_counter()
+            signature = self._read_files_signature()
+            class_indices = self.read_class_indices()
+            model, light_model, crop_models = self._load_models()
+            self.load_seconds = round(time.perf_counter() - started, 3)
+            version = self.configured_version or self._file_version(class_indices)
+            self._install(model, class_indices, version, light_model, crop_models)
+            self._files_signature = signature
+        except Exception as e:
+            self.state = FAILED
+            self.error = str(e)
+            raise
+        logger.info('Crop disease model ready (load %.2fs, warmup %.2fs)',
+                    self.load_seconds, self.warmup_seconds)
+
+    def _reload(self, raise_errors=False):
+        models = []
+        try:
+            with self._lock:
+                started = time.perf_counter()
+                signature = self._read_files_signature()
+                class_indices = self.read_class_indices()
+                model, light_model, crop_models = self._load_models()
+                models = [model, light_model, *crop_models.values()]
+                load_seconds = round(time.perf_counter() - started, 3)
+                # A configured version names the files loaded at startup; new
+                # files are told apart by their own identity
+                self._install(model, class_indices, self._file_version(class_indices), light_model, crop_models)
+                self.load_seconds = load_seconds
+                self.error = None
+                self.reload_error = None
+                self.reloads += 1
+                self._files_signature = signature
+            logger.info('Crop disease model %s swapped in (load %.2fs, warmup %.2fs)',
+                        self.version, self.load_seconds, self.warmup_seconds)
+        except Exception as e:
+            self.reload_error = str(e)
+            if models and models[0] is not self.model:
+                for model in models:
+                    if hasattr(model, 'close'):
+                        model.close()
+            if raise_errors:
+                raise
+            logger.exception('Model reload failed, still serving %s', self.version)
+        finally:
+            with self._swap_lock:
+                self.reloading = False
+
+    def _watch(self, interval):
+        failed_signature = None
+        while not self._closed.wait(interval):
+            if self.state != READY or self.reloading:
+                continue
+            try:
+                signature = self._read_files_signature()
+            except OSError:
+                continue  # Being replaced
+            if signature in (self._files_signature, failed_signature):
+                continue
+            try:
+                self.reload(wait=True)
+            except Exception:
+                # Don't retry the same files until they change again
+                failed_signature = signature
+                logger.exception('Model reload failed, still serving %s', self.version)
+
+    def wrap_model(self, model):
+        """Apply the configured compilation to an in-memory Keras model."""
+        return compile_model(model, self.input_shape, self.compiled, self.jit_compile)
+
+    def _load_models(self):
+        # The full model, the cascade's light model (or None) and the per-crop
+        # models by file name
+        if self.crop_models_dir and self.inference_mode == 'process':
+            raise ValueError("Crop models can't be used with inference_mode='process'; "
+                             "unset the crop models directory or use 'thread' mode")
+        loaded = []
+        try:
+            light_model = self._load_model(self.light_model_path) if self.light_model_path else None
+            loaded.append(light_model)
+            crop_models = {}
+            for name, path in self._crop_model_paths():
+                crop_models[name] = self._load_model(path)
+                loaded.append(crop_models[name])
+            return self._load_model(self.model_path), light_model, crop_models
+        except Exception:
+            for model in loaded:
+                if hasattr(model, 'close'):
+                    model.close()
+            raise
+
+    def _crop_model_paths(self):
+        if not self.crop_models_dir:
+            return []
+        return [
+            (os.path.splitext(filename)[0], os.path.join(self.crop_models_dir, filename))
+            for filename in sorted(os.listdir(self.crop_models_dir))
+            if filename.endswith(('.h5', '.keras'))
+        ]
+
+    def _load_model(self, model_path):
+        # TensorFlow is only imported by the loader, so processes that never
+        # predict don't pay for it
+        loader = functools.partial(
+            load_keras_model, compiled=self.compiled, jit_compile=self.jit_compile,
+            input_shape=self.input_shape,
+        )
+        if self.inference_mode == 'process':
+            # Inference runs in pre-warmed worker processes; this process never loads TensorFlow
+            from .inference_pool import ProcessInferencePool
+            pool = ProcessInferencePool(
+                model_path,
+                input_shape=self.input_shape,
+                slot_capacity=self.batch_max_size,
+                model_loader=loader,
+                **self.pool_options
+            )
+            return pool.start()
+        return loader(model_path)
+
+    def _install(self, model, class_indices, version, light_model=None, crop_models=None):
+        import numpy as np
+
+        # A first load isn't ready until warm; a replacement warms up while
+        # the current version keeps serving
+        if self.current is None:
+            self.state = WARMING_UP
+        started = time.perf_counter()
+        dummy = np.zeros((1,) + self.input_shape, dtype='float32')
+        for _ in range(self.warmup_runs):
+            model.predict(dummy)
+            if light_model is not None:
+                light_model.predict(dummy)
+        self.warmup_seconds = round(time.perf_counter() - started, 3)
+        batcher = MicroBatcher(model, max_batch_size=self.batch_max_size, max_wait_ms=self.batch_max_wait_ms)
+        cascade = None
+        if light_model is not None:
+            cascade = Cascade(light_model, self.cascade_threshold, MicroBatcher(
+                light_model, max_batch_size=self.batch_max_size, max_wait_ms=self.batch_max_wait_ms
+            ))
+            # Cached results depend on both models
+            version = f'{version}+{self._file_id(self.light_model_path) if self.light_model_path else "light"}'
+        new = ModelVersion(model, class_indices, version, batcher, cascade)
+        if crop_models:
+            self._install_crop_heads(new, crop_models, dummy)
+            new.version = f'{new.version}+crops-{self._crop_models_id(crop_models):08x}'
+        with self._swap_lock:
+            old, self.current = self.current, new
+        self.state = READY
+        if old is not None:
+            old.retire()
+
+    def _install_crop_heads(self, version, crop_models, dummy):
+        for name, model in crop_models.items():
+            try:
+                crop = version.resolve_crop(name)
+            except UnknownCrop as e:
+                raise ValueError(f'Crop model {name}: {e}')
+            classes = version.crop_groups[crop]
+            for _ in range(max(1, self.warmup_runs)):
+                outputs = model.predict(dummy).shape[-1]
+            if outputs != len(classes):
+                raise ValueError(f'Crop model {name} predicts {outputs} classes, {crop} has {len(classes)}')
+            batcher = MicroBatcher(model, max_batch_size=self.batch_max_size, max_wait_ms=self.batch_max_wait_ms)
+            version.crop_heads[crop] = CropHead(model, classes, len(version.class_names), batcher)
+
+    def _crop_models_id(self, crop_models):
+        # Cached results depend on the per-crop models too
+        paths = dict(self._crop_model_paths())
+        ids = [self._file_id(paths[name]) if name in paths else name for name in sorted(crop_models)]
+        return zlib.crc32(','.join(ids).encode())
+
+    def _read_files_signature(self):
+        paths = [self.model_path, self.class_indices_path, self.light_model_path]
+        paths.extend(path for name, path in self._crop_model_paths())
+        return tuple((stat.st_size, stat.st_mtime_ns) for stat in map(os.stat, filter(None, paths)))
+
+    def _file_id(self, path):
+        # Cheap identity for weights on disk: changes whenever the file is replaced
+        stat = os.stat(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        return f'{name}-{stat.st_size:x}-{int(stat.st_mtime):x}'
+
+    def _file_version(self, class_indices):
+        # Changes whenever the model file is replaced or the class indices change
+        indices = zlib.crc32(json.dumps(class_indices, sort_keys=True).encode())
+        return f'{self._file_id(self.model_path)}-{indices:08x}'
+
+    def read_class_indices(self):
+        with open(self.class_indices_path, 'r') as f:
+            return json.load(f)
+
+
+registry = ModelRegistry(
+    settings.CROP_DISEASE_MODEL_PATH,
+    settings.CROP_DISEASE_CLASS_INDICES_PATH,
+    warmup_runs=settings.CROP_DISEASE_WARMUP_RUNS,
+    batch_max_size=settings.CROP_DISEASE_BATCH_MAX_SIZE,
+    batch_max_wait_ms=settings.CROP_DISEASE_BATCH_MAX_WAIT_MS,
+    version=settings.CROP_DISEASE_MODEL_VERSION,
+    compiled=settings.CROP_DISEASE_COMPILED_INFERENCE,
+    jit_compile=settings.CROP_DISEASE_XLA_JIT,
+    inference_mode=settings.CROP_DISEASE_INFERENCE_MODE,
+    light_model_path=settings.CROP_DISEASE_LIGHT_MODEL_PATH,
+    cascade_threshold=settings.CROP_DISEASE_CASCADE_THRESHOLD,
+    crop_models_dir=settings.CROP_DISEASE_CROP_MODELS_DIR,
+    pool_options={
+        'processes': settings.CROP_DISEASE_INFERENCE_PROCESSES,
+        'intra_op_threads': settings.CROP_DISEASE_TF_INTRA_OP_THREADS,
+        'inter_op_threads': settings.CROP_DISEASE_TF_INTER_OP_THREADS,
+        'warmup_runs': settings.CROP_DISEASE_WARMUP_RUNS,
+    },
+)
+
+
+def start_serving():
+    # Startup hook for server processes, called from Plantify/wsgi.py and
+    # asgi.py: load and warm the model before serving instead of on the first
+    # prediction request. Not run from AppConfig.ready, which every management
+    # command, the autoreloader's parent and spawned workers also go through
+    if settings.CROP_DISEASE_PRELOAD_MODEL:
+        registry.load_in_background()
+    if settings.CROP_DISEASE_MODEL_WATCH_INTERVAL:
+        registry.watch(settings.CROP_DISEASE_MODEL_WATCH_INTERVAL)
+
+
+@metrics.register_collector
+def collect_registry_metrics():
+    active = registry.current
+    collected = [
+        ('plantify_model_ready', 'gauge', 'Whether the crop disease model has loaded and warmed up.',
+         [({'version': active.version if active else ''}, int(registry.is_ready()))]),
+        ('plantify_model_reloads_total', 'counter', 'Model versions swapped in by a reload.',
+         [({}, registry.reloads)]),
+    ]
+    if active is None:
+        return collected
+    # The batcher belongs to the version, so these start over after a reload
+    stats = active.batcher.stats()
+    return collected + [
+        ('plantify_batcher_batches_total', 'counter', 'Batched model calls made by the micro-batcher.',
+         [({}, stats['batches'])]),
+        ('plantify_batcher_samples_total', 'counter', 'Images predicted through the micro-batcher.',
+         [({}, stats['samples'])]),
+        ('plantify_batcher_batches_by_size_total', 'counter', 'Batches run by the micro-batcher, by size.',
+         [({'size': size}, count) for size, count in stats['batch_size_counts'].items()]),
+        ('plantify_batcher_queue_wait_seconds_max', 'gauge', 'Longest time an image waited for a batch.',
+         [({}, stats['max_queue_wait_ms'] / 1000.0)]),
+        ('plantify_batcher_queue_depth', 'gauge', 'Images waiting for the next batch.',
+         [({}, stats['queue_depth'])]),
+    ]
@@ -0,0 +1,58 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import DiseaseDailyCount, PredictionHistory, UserDiseaseDailyCount
+
+
+def _increment(model, amount, **key):
+    if model.objects.filter(**key).update(count=F('count') + amount):
+        return
+    # First prediction of this disease on this day; get_or_create copes with a
+    # concurrent writer creating the row first
+    counter, created = model.objects.get_or_create(defaults={'count': amount}, **key)
+    if not created:
+        model.objects.filter(**key).update(count=F('count') + amount)
+
+
+def add_to_rollups(rows):
+    """
+    Add freshly inserted PredictionHistory ``rows`` to the daily counts. Call it
+    in the transaction that inserted them so the two never disagree.
+    """
+    per_user = Counter((row.user_id, timezone.localdate(row.created_at), row.disease) for row in rows)
+    per_day = Counter()
+    for (user_id, day, disease), count in per_user.items():
+        per_day[day, disease] += count
+
+    for (day, disease), count in per_day.items():
+        _increment(DiseaseDailyCount, count, day=day, disease=disease)
+    for (user_id, day, disease), count in per_user.items():
+        _increment(UserDiseaseDailyCount, count, user_id=user_id, day=day, disease=disease)
+
+
+def rebuild_rollups(batch_size=1000):
+    """
+    Recompute every daily count from PredictionHistory.
+
+    Returns:
+        (global rows, per-user rows) written
+    """
+    history = PredictionHistory.objects.annotate(day=TruncDate('created_at')).order_by()
+    with transaction.atomic():
+        DiseaseDailyCount.objects.all().delete()
+        UserDiseaseDailyCount.objects.all().delete()
+        global_counts = DiseaseDailyCount.objects.bulk_create(
+            (DiseaseDailyCount(day=row['day'], disease=row['disease'], count=row['count'])
+             for row in history.values('day', 'disease').annotate(count=Count('id')).iterator()),
+            batch_size=batch_size,
+        )
+        user_counts = UserDiseaseDailyCount.objects.bulk_create(
+            (UserDiseaseDailyCount(user_id=row['user'], day=row['day'], disease=row['disease'], count=row['count'])
+             for row in history.values('user', 'day', 'disease').annotate(count=Count('id')).iterator()),
+            batch_size=batch_size,
+        )
+    return len(global_counts), len(user_counts)
@@ -0,0 +1,44 @@
+import os
+
+# Helpers for the bulk_scan management command. Decode workers are spawned
+# processes that never set up Django (so no startup hook runs in them): nothing
+# here may touch Django.
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+
+
+def iter_image_files(root):
+    """
+    Yield the path of every image under ``root``, relative to it, in a stable
+    (sorted, depth-first) order so a scan can be resumed by position.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+        for name in sorted(filenames):
+            if name.startswith('.') or not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            yield os.path.relpath(os.path.join(dirpath, name), root)
+
+
+def decode_chunk(root, paths, target_size=(224, 224), fast=False):
+    """
+    Decode ``paths`` (relative to ``root``) into one float32 batch.
+
+    Returns:
+        (batch, errors): ``batch`` has one row per path; ``errors`` maps the
+        index of every path that couldn't be decoded to its message (its row
+        is left unset)
+    """
+    import numpy as np
+
+    from .preprocess import load_and_preprocess_image
+
+    width, height = target_size
+    batch = np.empty((len(paths), height, width, 3), dtype='float32')
+    errors = {}
+    for i, path in enumerate(paths):
+        try:
+            load_and_preprocess_image(os.path.join(root, path), target_size, fast=fast, out=batch[i])
+        except Exception as e:
+            errors[i] = str(e)
+    return batch, errors
@@ -0,0 +1,18 @@
+from rest_framework import serializers
+from .models import PredictionHistory
+
+
+class PredictionHistorySerializer(serializers.ModelSerializer):
+    image_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = PredictionHistory
+        fields = ['id', 'disease', 'confidence', 'created_at', 'image_url']
+
+    def get_image_url(self, obj):
+        if obj.image and hasattr(obj.image, 'url'):
+            request = self.context.get('request')
+            if request:
+                return request.build_absolute_uri(obj.image.url)
+            return obj.image.url
+        return None
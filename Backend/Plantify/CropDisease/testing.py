@@ -0,0 +1,24 @@
+# Test doubles that spawned inference worker processes can import. Nothing here
+# may depend on Django being set up.
+import numpy as np
+
+
+class FakeModel:
+    """Stand-in for the Keras model: one probability row per input image."""
+
+    def __init__(self, num_classes=38):
+        self.num_classes = num_classes
+        self.batch_sizes = []
+
+    def predict(self, batch):
+        self.batch_sizes.append(len(batch))
+        # Class chosen from the mean pixel value so each row is distinguishable
+        scores = np.zeros((len(batch), self.num_classes), dtype='float32')
+        classes = np.rint(batch.reshape(len(batch), -1).mean(axis=1) * 100).astype(int) % self.num_classes
+        scores[np.arange(len(batch)), classes] = 1.0
+        return scores
+
+
+def build_fake_model(model_path):
+    # Module-level so inference worker processes can unpickle it
+    return FakeModel()
@@ -1,3 +1,1227 @@
-from django.test import TestCase
+import csv
+import datetime
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .batching import MicroBatcher
+from .cache import PredictionCache, prediction_cache
+from .cascade import Cascade, cascade_stats, predict_cascade
+from .crops import UnknownCrop, restrict_predictions
+from .compiled import CompiledModel
+from .executor import BoundedExecutor
+from .history import HistoryRecorder
+from .inference_pool import ProcessInferencePool
+from .metrics import Histogram
+from .models import DiseaseDailyCount, PredictionHistory, UserDiseaseDailyCount
+from .rollups import add_to_rollups
+from .postprocess import class_names_from_indices, postprocess_predictions
+from .registry import ModelRegistry, registry, start_serving
+from .testing import FakeModel, build_fake_model
+from .tta import build_augmentations
+from .views import load_and_preprocess_image, predict_image_class
+
+
+def make_image_bytes(size=(320, 240), color=(40, 160, 60), format='JPEG'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+class MicroBatcherTests(SimpleTestCase):
+    def test_concurrent_requests_share_a_batch(self):
+        model = FakeModel()
+        batcher = MicroBatcher(model, max_batch_size=8, max_wait_ms=200)
+        self.addCleanup(batcher.close)
+        results = {}
+
+        def worker(i):
+            sample = np.full((1, 4, 4, 3), i / 100.0, dtype='float32')
+            results[i] = batcher.predict(sample)[0]
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # Every caller gets back its own row
+        for i, row in results.items():
+            self.assertEqual(int(np.argmax(row)), i)
+        self.assertLess(len(model.batch_sizes), 8)
+        stats = batcher.stats()
+        self.assertEqual(stats['samples'], 8)
+        self.assertEqual(stats['batches'], len(model.batch_sizes))
+        self.assertGreater(stats['mean_batch_size'], 1)
+
+    def test_batch_never_exceeds_max_size(self):
+        model = FakeModel()
+        batcher = MicroBatcher(model, max_batch_size=3, max_wait_ms=50)
+        self.addCleanup(batcher.close)
+        batcher.predict(np.zeros((10, 4, 4, 3), dtype='float32'))
+        self.assertLessEqual(max(model.batch_sizes), 3)
+        self.assertEqual(sum(model.batch_sizes), 10)
+
+    def test_model_errors_reach_every_caller(self):
+        class BrokenModel:
+            def predict(self, batch):
+                raise RuntimeError('boom')
+
+        batcher = MicroBatcher(BrokenModel(), max_batch_size=4, max_wait_ms=1)
+        self.addCleanup(batcher.close)
+        with self.assertRaisesMessage(RuntimeError, 'boom'):
+            batcher.predict(np.zeros((2, 4, 4, 3), dtype='float32'))
+
+
+class LoadAndPreprocessImageTests(SimpleTestCase):
+    def test_decodes_bytes_file_objects_and_uploads_alike(self):
+        data = make_image_bytes()
+        upload = SimpleUploadedFile('leaf.jpg', data, content_type='image/jpeg')
+        # Read the upload once first, as the view may do before decoding
+        upload.read()
+        expected = load_and_preprocess_image(data)
+        for source in (io.BytesIO(data), upload):
+            np.testing.assert_array_equal(load_and_preprocess_image(source), expected)
+        self.assertEqual(expected.shape, (1, 224, 224, 3))
+        self.assertEqual(expected.dtype, np.float32)
+
+    def test_fast_decode_stays_close_to_exact_decode(self):
+        # Large photo with a gradient so the reduced-scale decode has detail to lose
+        gradient = np.linspace(0, 255, 2000, dtype='uint8')
+        pixels = np.stack(np.broadcast_arrays(gradient[None, :], gradient[:, None], 128), axis=-1)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels[:1500].astype('uint8')).save(buffer, format='JPEG', quality=90)
+        data = buffer.getvalue()
+
+        exact = load_and_preprocess_image(data, fast=False)
+        fast = load_and_preprocess_image(data, fast=True)
+        self.assertEqual(fast.shape, exact.shape)
+        self.assertLess(float(np.abs(fast - exact).mean()), 0.01)
+
+    def test_writes_into_given_buffer(self):
+        batch = np.zeros((2, 224, 224, 3), dtype='float32')
+        returned = load_and_preprocess_image(make_image_bytes(), out=batch[1])
+        self.assertTrue(np.shares_memory(returned, batch))
+        np.testing.assert_array_equal(batch[1], load_and_preprocess_image(make_image_bytes())[0])
+        self.assertFalse(batch[0].any())
+
+    def test_invalid_image_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            load_and_preprocess_image(b'not an image')
+
+
+class ModelRegistryTests(SimpleTestCase):
+    def make_registry(self, **kwargs):
+        new_registry = ModelRegistry('missing.h5', registry.class_indices_path, **kwargs)
+        self.addCleanup(new_registry.close)
+        return new_registry
+
+    def test_set_model_runs_warmup_before_ready(self):
+        model = FakeModel()
+        new_registry = self.make_registry(warmup_runs=3)
+        self.assertFalse(new_registry.is_ready())
+        new_registry.set_model(model)
+        self.assertTrue(new_registry.is_ready())
+        self.assertEqual(model.batch_sizes, [1, 1, 1])
+        self.assertEqual(new_registry.class_indices['0'], 'Apple___Apple_scab')
+
+    def test_failed_load_is_reported(self):
+        new_registry = self.make_registry()
+        with self.assertRaises(Exception):
+            new_registry.load()
+        self.assertEqual(new_registry.status()['state'], 'failed')
+        self.assertFalse(new_registry.is_ready())
+
+    def test_crop_models_are_refused_in_process_mode(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        model_path = os.path.join(directory.name, 'model.h5')
+        crops_dir = os.path.join(directory.name, 'crops')
+        os.mkdir(crops_dir)
+        for path in (model_path, os.path.join(crops_dir, 'Apple.h5')):
+            open(path, 'wb').close()
+        new_registry = ModelRegistry(model_path, registry.class_indices_path, inference_mode='process',
+                                     crop_models_dir=crops_dir)
+        self.addCleanup(new_registry.close)
+
+        with mock.patch.object(new_registry, '_load_model') as load_model:
+            with self.assertRaisesRegex(ValueError, "inference_mode='process'"):
+                new_registry.load()
+        load_model.assert_not_called()
+        self.assertEqual(new_registry.status()['state'], 'failed')
+
+    def make_reloadable_registry(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        model_path = os.path.join(directory.name, 'model.h5')
+        with open(model_path, 'wb') as f:
+            f.write(b'v1')
+        new_registry = ModelRegistry(model_path, registry.class_indices_path, warmup_runs=1)
+        self.addCleanup(new_registry.close)
+        models = [FakeModel(), FakeModel()]
+        loader = mock.patch.object(new_registry, '_load_model', side_effect=models)
+        loader.start()
+        self.addCleanup(loader.stop)
+        return new_registry, models
+
+    def test_reload_swaps_versions_without_disturbing_requests_in_flight(self):
+        new_registry, (old_model, new_model) = self.make_reloadable_registry()
+        with new_registry.acquire() as held:
+            with open(new_registry.model_path, 'wb') as f:
+                f.write(b'v2, retrained')
+            self.assertTrue(new_registry.reload(wait=True))
+            # Warmed up before being swapped in
+            self.assertEqual(new_model.batch_sizes, [1])
+            self.assertNotEqual(new_registry.version, held.version)
+            self.assertTrue(new_registry.is_ready())
+            # The request that started on the old version finishes on it
+            held.batcher.predict(np.zeros((1, 224, 224, 3), dtype='float32'))
+            self.assertEqual(old_model.batch_sizes, [1, 1])
+        with new_registry.acquire() as active:
+            self.assertIs(active.model, new_model)
+        self.assertEqual(new_registry.status()['reloads'], 1)
+
+    def test_failed_reload_keeps_serving_the_current_version(self):
+        new_registry, models = self.make_reloadable_registry()
+        new_registry.load()
+        version = new_registry.version
+        models[1].predict = mock.Mock(side_effect=RuntimeError('corrupt weights'))
+        with self.assertRaisesMessage(RuntimeError, 'corrupt weights'):
+            new_registry.reload(wait=True)
+        self.assertEqual(new_registry.version, version)
+        self.assertTrue(new_registry.is_ready())
+        self.assertEqual(new_registry.status()['reload_error'], 'corrupt weights')
+
+    def test_watcher_reloads_replaced_files(self):
+        new_registry, (old_model, new_model) = self.make_reloadable_registry()
+        new_registry.load()
+        new_registry.watch(0.01)
+        with open(new_registry.model_path, 'wb') as f:
+            f.write(b'v2, retrained')
+        for _ in range(500):
+            if new_registry.model is new_model:
+                break
+            time.sleep(0.01)
+        self.assertIs(new_registry.model, new_model)
+
+
+class PredictionViewTestMixin:
+    """Installs a FakeModel in the shared registry for the duration of a test."""
+
+    registry_attributes = ('current', 'state')
+
+    def setUp(self):
+        super().setUp()
+        self.model = FakeModel()
+        saved = {name: getattr(registry, name) for name in self.registry_attributes}
+        registry.set_model(self.model, version='test')
+        prediction_cache.clear()
+
+        def restore():
+            installed = registry.current
+            for name, value in saved.items():
+                setattr(registry, name, value)
+            if installed is not saved['current']:
+                installed.retire()
+            prediction_cache.clear()
+        self.addCleanup(restore)
+
+
+class ReadinessViewTests(PredictionViewTestMixin, SimpleTestCase):
+    def test_reports_ready_after_warmup(self):
+        response = self.client.get(reverse('model_ready'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['ready'])
+
+    def test_reports_not_ready_while_warming_up(self):
+        registry.state = 'warming_up'
+        response = self.client.get(reverse('model_ready'))
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.json()['ready'])
+
+
+IMPORT_BUDGET_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+from django.urls import resolve
+for url in ('/account/login/', '/account/profile/', '/crop-disease/predict/', '/crop-disease/ready/'):
+    resolve(url)
+print(json.dumps({
+    'seconds': time.perf_counter() - started,
+    'modules': [m for m in ('tensorflow', 'keras', 'numpy') if m in sys.modules],
+}))
+"""
+
+
+class PostprocessPredictionsTests(SimpleTestCase):
+    class_names = class_names_from_indices({'0': 'a', '1': 'b', '2': 'c', '3': 'd'})
+
+    def test_top1_matches_argmax(self):
+        predictions = np.array([[0.1, 0.6, 0.2, 0.1], [0.4, 0.4, 0.1, 0.1]], dtype='float32')
+        results = postprocess_predictions(predictions, self.class_names)
+        self.assertEqual(results, [
+            {'disease_name': 'b', 'confidence': 60.0},
+            {'disease_name': 'a', 'confidence': 40.0},
+        ])
+
+    def test_top_k_is_sorted_and_filtered_per_row(self):
+        predictions = np.array([[0.05, 0.5, 0.3, 0.15], [0.7, 0.01, 0.09, 0.2]], dtype='float32')
+        results = postprocess_predictions(predictions, self.class_names, top_k=3, min_confidence=10)
+        self.assertEqual([p['disease_name'] for p in results[0]['top_k']], ['b', 'c', 'd'])
+        self.assertEqual([p['disease_name'] for p in results[1]['top_k']], ['a', 'd'])
+        self.assertEqual(results[1]['disease_name'], 'a')
+
+    def test_top_k_larger_than_class_count(self):
+        predictions = np.array([[0.1, 0.2, 0.3, 0.4]], dtype='float32')
+        results = postprocess_predictions(predictions, self.class_names, top_k=10)
+        self.assertEqual([p['disease_name'] for p in results[0]['top_k']], ['d', 'c', 'b', 'a'])
+
+
+class HistogramTests(SimpleTestCase):
+    def test_renders_cumulative_prometheus_buckets(self):
+        histogram = Histogram('demo_seconds', 'Demo.', labelnames=('stage',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 3.0):
+            histogram.observe(value, stage='decode')
+        self.assertEqual(histogram.render(), [
+            '# HELP demo_seconds Demo.',
+            '# TYPE demo_seconds histogram',
+            'demo_seconds_bucket{stage="decode",le="0.1"} 1',
+            'demo_seconds_bucket{stage="decode",le="1.0"} 3',
+            'demo_seconds_bucket{stage="decode",le="+Inf"} 4',
+            'demo_seconds_sum{stage="decode"} 4.05',
+            'demo_seconds_count{stage="decode"} 4',
+        ])
+
+
+class PredictionCacheTests(SimpleTestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = PredictionCache(max_entries=2)
+        cache.get_or_compute('a', lambda: 1)
+        cache.get_or_compute('b', lambda: 2)
+        cache.get_or_compute('a', lambda: 1)
+        cache.get_or_compute('c', lambda: 3)
+        self.assertEqual(cache.get_or_compute('a', lambda: 0), (1, True))
+        self.assertEqual(cache.get_or_compute('b', lambda: 0), (0, False))
+
+    def test_concurrent_identical_requests_share_one_computation(self):
+        cache = PredictionCache(max_entries=8)
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            release.wait(5)
+            return {'disease_name': 'x'}
+
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get_or_compute('k', compute)))
+            for _ in range(5)
+        ]
+        for t in threads:
+            t.start()
+        while cache.stats()['coalesced'] < 4:
+            threading.Event().wait(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(cached for _, cached in results), [False, True, True, True, True])
+
+    def test_errors_are_not_cached(self):
+        cache = PredictionCache(max_entries=8)
+
+        def fail():
+            raise ValueError('bad image')
+
+        with self.assertRaises(ValueError):
+            cache.get_or_compute('k', fail)
+        self.assertEqual(cache.get_or_compute('k', lambda: 1), (1, False))
+
+    def test_key_depends_on_model_version(self):
+        self.assertNotEqual(PredictionCache.make_key(b'img', 'v1'), PredictionCache.make_key(b'img', 'v2'))
+
+
+class PredictDiseaseViewTests(PredictionViewTestMixin, SimpleTestCase):
+    def post_image(self, data):
+        upload = SimpleUploadedFile('leaf.jpg', data, content_type='image/jpeg')
+        return self.client.post(reverse('predict_disease'), {'image': upload})
+
+    def test_repeated_upload_is_served_from_cache(self):
+        data = make_image_bytes()
+        first = self.post_image(data)
+        second = self.post_image(data)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()['model_version'], 'test')
+        self.assertFalse(first.json()['cached'])
+        self.assertTrue(second.json()['cached'])
+        self.assertEqual(first.json()['disease_name'], second.json()['disease_name'])
+        # Warmup runs plus a single real inference
+        self.assertEqual(len(self.model.batch_sizes), registry.warmup_runs + 1)
+
+    def test_stage_timings_in_server_timing_header_and_metrics(self):
+        response = self.post_image(make_image_bytes())
+        stages = [part.split(';')[0] for part in response['Server-Timing'].split(', ')]
+        for stage in ('read', 'decode', 'resize', 'normalize', 'model', 'postprocess', 'encode', 'total'):
+            self.assertIn(stage, stages)
+
+        cached = self.post_image(make_image_bytes())
+        self.assertIn('cache;dur=0.00;desc="hit"', cached['Server-Timing'])
+        self.assertNotIn('model;', cached['Server-Timing'])
+
+        metrics = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('plantify_predict_stage_seconds_bucket{stage="model",le="+Inf"}', metrics)
+        self.assertIn('plantify_predict_request_seconds_count{view="predict",status="200"}', metrics)
+        self.assertIn('plantify_prediction_cache_hits_total', metrics)
+
+    def test_top_k_option(self):
+        upload = SimpleUploadedFile('leaf.jpg', make_image_bytes(), content_type='image/jpeg')
+        response = self.client.post(reverse('predict_disease'), {'image': upload, 'top_k': '3'})
+        result = response.json()
+        self.assertEqual(len(result['top_k']), 3)
+        self.assertEqual(result['top_k'][0]['disease_name'], result['disease_name'])
+
+    def test_invalid_top_k_is_rejected(self):
+        upload = SimpleUploadedFile('leaf.jpg', make_image_bytes(), content_type='image/jpeg')
+        response = self.client.post(reverse('predict_disease'), {'image': upload, 'top_k': 'lots'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_missing_image_is_rejected(self):
+        response = self.client.post(reverse('predict_disease'))
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(CROP_DISEASE_TTA_THRESHOLD=100.5)
+    def test_tta_threshold_setting(self):
+        response = self.post_image(make_image_bytes())
+        self.assertTrue(response.json()['tta'])
+        self.assertEqual(self.model.batch_sizes[-2:], [1, 7])
+
+    def test_oversized_uploads_are_rejected_before_decoding(self):
+        noise = np.random.default_rng(0).integers(0, 256, (240, 320, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(noise).save(buffer, format='JPEG', quality=95)
+        data = buffer.getvalue()
+        warmup_runs = len(self.model.batch_sizes)
+
+        # Too large for Content-Length alone, and caught while streaming
+        for max_bytes in (1000, len(data) - 1):
+            with override_settings(CROP_DISEASE_UPLOAD_MAX_BYTES=max_bytes):
+                response = self.post_image(data)
+            self.assertEqual(response.status_code, 413)
+            self.assertIn('bytes', response.json()['error'])
+
+        # Only the header of an image with too many pixels needs to arrive
+        with override_settings(CROP_DISEASE_UPLOAD_MAX_PIXELS=320 * 240 - 1):
+            response = self.post_image(data[:2048])
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('pixels', response.json()['error'])
+
+        response = self.post_image(b'not an image')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.model.batch_sizes), warmup_runs)
+
+        metrics = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('plantify_upload_rejected_total{reason="pixels"}', metrics)
+
+    def test_header_after_a_large_icc_profile_is_found(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (320, 240)).save(buffer, format='JPEG', icc_profile=os.urandom(1200 * 1024))
+        data = buffer.getvalue()
+        self.assertEqual(self.post_image(data).status_code, 200)
+        with override_settings(CROP_DISEASE_UPLOAD_MAX_PIXELS=320 * 240 - 1):
+            response = self.post_image(data)
+        self.assertEqual(response.status_code, 413)
+
+        uploads = [SimpleUploadedFile(f'leaf{i}.jpg', data, content_type='image/jpeg') for i in range(2)]
+        with override_settings(CROP_DISEASE_UPLOAD_MAX_PIXELS=320 * 240):
+            response = self.client.post(reverse('predict_disease_batch'), {'images': uploads[:1]})
+            self.assertIn('disease_name', json.loads(b''.join(response.streaming_content)))
+        with override_settings(CROP_DISEASE_UPLOAD_MAX_PIXELS=320 * 240 - 1):
+            response = self.client.post(reverse('predict_disease_batch'), {'images': uploads[1:]})
+            self.assertEqual(json.loads(b''.join(response.streaming_content))['error'],
+                             'Image has more than 76799 pixels')
+
+    def test_decompression_bomb_reports_pils_limit(self):
+        with override_settings(CROP_DISEASE_UPLOAD_MAX_PIXELS=0), \
+                mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 1000):
+            response = self.post_image(make_image_bytes())
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.json()['error'], 'Image has more than 2000 pixels')
+
+
+class SometimesUnsureModel(FakeModel):
+    """FakeModel that is only 50% sure about the odd-numbered classes."""
+
+    def predict(self, batch):
+        scores = super().predict(batch)
+        scores[:, 1::2] *= 0.5
+        return scores
+
+
+class ModelCascadeTests(PredictionViewTestMixin, SimpleTestCase):
+    def image(self, value):
+        return np.full((1, 224, 224, 3), value / 100.0, dtype='float32')
+
+    def test_only_unsure_images_are_escalated(self):
+        light, full = SometimesUnsureModel(), FakeModel()
+        cascade = Cascade(light, threshold=90)
+        batch = np.concatenate([self.image(value) for value in (2, 3, 4, 5)])
+        before = cascade_stats()
+
+        predictions, escalated = predict_cascade(full, batch, cascade)
+        self.assertEqual(escalated.tolist(), [False, True, False, True])
+        self.assertEqual(full.batch_sizes, [2])
+        np.testing.assert_array_equal(predictions, FakeModel().predict(batch))
+        stats = cascade_stats()
+        self.assertEqual(stats['light'] - before['light'], 2)
+        self.assertEqual(stats['full'] - before['full'], 2)
+
+        # Without a cascade every image goes to the full model
+        self.assertTrue(predict_cascade(full, batch)[1].all())
+
+    def test_predictions_report_escalation_and_tier_latency(self):
+        light = SometimesUnsureModel()
+        registry.set_model(self.model, version='test', light_model=light)
+        self.assertIsNotNone(registry.cascade)
+        self.assertEqual(registry.version, 'test+light')
+        warmup_runs = len(self.model.batch_sizes)
+
+        confident = self.client.post(reverse('predict_disease'), {
+            'image': SimpleUploadedFile('leaf.png', make_image_bytes(color=(0, 0, 0), format='PNG')),
+        })
+        self.assertFalse(confident.json()['escalated'])
+        self.assertEqual(len(self.model.batch_sizes), warmup_runs)
+        self.assertIn('model_light;', confident['Server-Timing'])
+        self.assertNotIn('model;', confident['Server-Timing'])
+
+        # Black picks class 0; a mean pixel value of 3/255 picks class 1, which
+        # the light model is unsure about
+        unsure = self.client.post(reverse('predict_disease'), {
+            'image': SimpleUploadedFile('leaf.png', make_image_bytes(color=(3, 3, 3), format='PNG')),
+        })
+        self.assertTrue(unsure.json()['escalated'])
+        self.assertEqual(unsure.json()['confidence'], 100.0)
+        self.assertEqual(len(self.model.batch_sizes), warmup_runs + 1)
+        self.assertIn('model;', unsure['Server-Timing'])
+
+        metrics = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('plantify_cascade_predictions_total{tier="full"}', metrics)
+        self.assertIn('plantify_cascade_escalation_ratio', metrics)
+        self.assertIn('plantify_predict_stage_seconds_count{stage="model_light"}', metrics)
+
+
+class CropHintTests(PredictionViewTestMixin, SimpleTestCase):
+    def post_image(self, crop, color=(40, 160, 60), url='predict_disease'):
+        upload = SimpleUploadedFile('leaf.png', make_image_bytes(color=color, format='PNG'))
+        field = 'images' if url == 'predict_disease_batch' else 'image'
+        return self.client.post(reverse(url), {field: upload, 'crop': crop})
+
+    def test_crop_groups_are_precomputed_from_labels(self):
+        groups = registry.current.crop_groups
+        self.assertEqual(len(groups), 14)
+        self.assertEqual([registry.class_names[i] for i in groups['Apple']], [
+            'Apple___Apple_scab', 'Apple___Black_rot', 'Apple___Cedar_apple_rust', 'Apple___healthy',
+        ])
+        self.assertEqual(registry.current.resolve_crop('corn'), 'Corn_(maize)')
+        self.assertEqual(registry.current.resolve_crop('Pepper, bell'), 'Pepper,_bell')
+        with self.assertRaises(UnknownCrop):
+            registry.current.resolve_crop('Banana')
+
+    def test_hint_restricts_the_full_model_to_the_crop(self):
+        # FakeModel picks class 23 (Soybean) for this color
+        unhinted = self.post_image('', color=(60, 60, 60)).json()
+        self.assertTrue(unhinted['disease_name'].startswith('Soybean___'))
+
+        result = self.post_image('tomato', color=(60, 60, 60)).json()
+        self.assertEqual(result['crop'], 'Tomato')
+        self.assertTrue(result['disease_name'].startswith('Tomato___'))
+
+        restricted = restrict_predictions(np.array([[0.2, 0.5, 0.3]]), np.array([0, 2]))
+        np.testing.assert_allclose(restricted, [[0.4, 0.0, 0.6]])
+
+    def test_registered_crop_model_answers_its_crop(self):
+        apple_model = FakeModel(num_classes=4)
+        registry.set_model(self.model, version='test', crop_models={'Apple': apple_model})
+        self.assertEqual(registry.version.split('+')[0], 'test')
+        calls = len(self.model.batch_sizes), len(apple_model.batch_sizes)
+
+        result = self.post_image('apple').json()
+        self.assertEqual(len(apple_model.batch_sizes), calls[1] + 1)
+        self.assertEqual(len(self.model.batch_sizes), calls[0])
+        self.assertTrue(result['disease_name'].startswith('Apple___'))
+        self.assertEqual(result['confidence'], 100.0)
+
+        # Crops without a model of their own fall back to the full model
+        self.post_image('grape')
+        self.assertEqual(len(self.model.batch_sizes), calls[0] + 1)
+
+        # A crop model for the wrong number of classes is refused, keeping the current version
+        version = registry.version
+        with self.assertRaisesMessage(ValueError, 'Crop model Orange predicts 4 classes, Orange has 1'):
+            registry.set_model(FakeModel(), crop_models={'Orange': FakeModel(num_classes=4)})
+        self.assertEqual(registry.version, version)
+
+    def test_top_k_stays_within_the_crop(self):
+        def post(url, field):
+            upload = SimpleUploadedFile('leaf.png', make_image_bytes(format='PNG'))
+            return self.client.post(reverse(url), {field: upload, 'crop': 'apple', 'top_k': '6'})
+
+        def assert_apple_only(result):
+            names = [entry['disease_name'] for entry in result['top_k']]
+            self.assertEqual(len(names), 4)
+            self.assertTrue(all(name.startswith('Apple___') for name in names), names)
+
+        assert_apple_only(post('predict_disease', 'image').json())
+        assert_apple_only(json.loads(b''.join(post('predict_disease_batch', 'images').streaming_content)))
+        # Per-crop models too, though their rows are widened to every label
+        registry.set_model(self.model, version='test', crop_models={'Apple': FakeModel(num_classes=4)})
+        prediction_cache.clear()
+        assert_apple_only(post('predict_disease', 'image').json())
+
+    def test_unknown_crop_is_rejected(self):
+        for url in ('predict_disease', 'predict_disease_async', 'predict_disease_batch'):
+            response = self.post_image('banana', url=url)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("Unknown crop 'banana'", response.json()['error'])
+
+
+class TestTimeAugmentationTests(SimpleTestCase):
+    class_names = class_names_from_indices({'0': 'a', '1': 'b'})
+
+    class SplitModel:
+        """Unsure about the original (55% 'a'), sure about every augmentation ('b')."""
+
+        def __init__(self):
+            self.batch_sizes = []
+
+        def predict(self, batch):
+            self.batch_sizes.append(len(batch))
+            row = [0.55, 0.45] if len(batch) == 1 else [0.0, 1.0]
+            return np.array([row] * len(batch), dtype='float32')
+
+    def test_augmentations_are_flips_and_crops_of_the_input(self):
+        image = np.arange(8 * 8 * 3, dtype='float32').reshape(8, 8, 3)
+        batch = build_augmentations(image, crop_fraction=0.5)
+        self.assertEqual(batch.shape, (7, 8, 8, 3))
+        np.testing.assert_array_equal(batch[0], image[:, ::-1])
+        np.testing.assert_array_equal(batch[1], image[::-1])
+        # Top-left crop stretched back to full size
+        np.testing.assert_array_equal(batch[2][::2, ::2], image[:4, :4])
+
+    def test_low_confidence_is_rescored_in_one_batched_call(self):
+        model = self.SplitModel()
+        result = predict_image_class(model, make_image_bytes(), self.class_names, tta_threshold=60)
+        self.assertEqual(model.batch_sizes, [1, 7])
+        self.assertTrue(result['tta'])
+        self.assertEqual(result['disease_name'], 'b')
+        self.assertEqual(result['confidence'], round((0.45 + 7) / 8 * 100, 2))
+
+    def test_confident_prediction_skips_augmentation(self):
+        model = self.SplitModel()
+        result = predict_image_class(model, make_image_bytes(), self.class_names, tta_threshold=50)
+        self.assertEqual(model.batch_sizes, [1])
+        self.assertNotIn('tta', result)
+
+
+class ProcessInferencePoolTests(SimpleTestCase):
+    def test_predicts_in_worker_processes_through_shared_memory(self):
+        pool = ProcessInferencePool(
+            'unused.h5', processes=2, input_shape=(4, 4, 3), slot_capacity=2,
+            model_loader=build_fake_model, start_timeout=60,
+        )
+        self.addCleanup(pool.close)
+        pool.start()
+
+        # Five rows split over three slots, results come back in order
+        batch = np.stack([np.full((4, 4, 3), i / 100.0, dtype='float32') for i in range(5)])
+        predictions = pool.predict(batch)
+
+        self.assertEqual(predictions.shape, (5, 38))
+        self.assertEqual(list(np.argmax(predictions, axis=1)), [0, 1, 2, 3, 4])
+
+
+@unittest.skipUnless(importlib.util.find_spec('tensorflow'), 'TensorFlow is not installed')
+class CompiledModelTests(SimpleTestCase):
+    def test_matches_keras_predict_for_any_batch_size(self):
+        from .management.commands.benchmark_inference import build_stub_model
+
+        keras_model = build_stub_model(38)
+        compiled = CompiledModel(keras_model)
+        for batch_size in (1, 3):
+            batch = np.random.default_rng(batch_size).random((batch_size, 224, 224, 3), dtype='float32')
+            np.testing.assert_allclose(
+                compiled.predict(batch), keras_model.predict(batch, verbose=0), rtol=1e-5, atol=1e-6
+            )
+
+
+class BoundedExecutorTests(SimpleTestCase):
+    def test_rejects_work_beyond_workers_and_queue(self):
+        executor = BoundedExecutor(max_workers=1, max_queue=1)
+        self.addCleanup(executor.shutdown)
+        release = threading.Event()
+        running = executor.try_submit(release.wait, 5)
+        queued = executor.try_submit(lambda: 'queued')
+        self.assertIsNone(executor.try_submit(lambda: 'rejected'))
+        release.set()
+        running.result(5)
+        self.assertEqual(queued.result(5), 'queued')
+        # Slots are handed back once work finishes
+        self.assertEqual(executor.try_submit(lambda: 'again').result(5), 'again')
+        self.assertEqual(executor.stats()['rejected'], 1)
+
+
+class PredictDiseaseAsyncViewTests(PredictionViewTestMixin, SimpleTestCase):
+    def post_image(self):
+        upload = SimpleUploadedFile('leaf.jpg', make_image_bytes(), content_type='image/jpeg')
+        return self.client.post(reverse('predict_disease_async'), {'image': upload})
+
+    def test_predicts_on_executor(self):
+        response = self.post_image()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('disease_name', response.json())
+
+    def test_saturated_executor_returns_429(self):
+        executor = BoundedExecutor(max_workers=1, max_queue=0)
+        release = threading.Event()
+        self.addCleanup(executor.shutdown)
+        self.addCleanup(release.set)
+        executor.try_submit(release.wait, 5)
+
+        with mock.patch('CropDisease.views.inference_executor', executor):
+            response = self.post_image()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], str(settings.CROP_DISEASE_ASYNC_RETRY_AFTER))
+
+
+@override_settings(CROP_DISEASE_BATCH_MAX_SIZE=2)
+class PredictDiseaseBatchViewTests(PredictionViewTestMixin, SimpleTestCase):
+    def read_ndjson(self, response):
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        body = b''.join(response.streaming_content).decode()
+        return [json.loads(line) for line in body.splitlines()]
+
+    def test_multipart_images_are_predicted_in_batches(self):
+        uploads = [
+            SimpleUploadedFile(f'leaf{i}.jpg', make_image_bytes(color=(i * 40, 100, 50)), content_type='image/jpeg')
+            for i in range(3)
+        ]
+        uploads.insert(1, SimpleUploadedFile('notes.jpg', b'not an image', content_type='image/jpeg'))
+        self.model.batch_sizes.clear()
+
+        response = self.client.post(reverse('predict_disease_batch'), {'images': uploads})
+
+        results = self.read_ndjson(response)
+        self.assertEqual([r['index'] for r in results], [0, 1, 2, 3])
+        self.assertEqual(results[1]['filename'], 'notes.jpg')
+        self.assertIn('error', results[1])
+        for result in (results[0], results[2], results[3]):
+            self.assertEqual(set(result), {'index', 'filename', 'disease_name', 'confidence', 'model_version'})
+        # Two batches of two inputs, the undecodable one dropped from the second
+        self.assertEqual(self.model.batch_sizes, [1, 2])
+
+    def test_zip_archive_members_are_predicted(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zf:
+            zf.writestr('field/a.jpg', make_image_bytes())
+            zf.writestr('field/b.png', make_image_bytes(format='PNG'))
+            zf.writestr('field/readme.txt', 'ignored')
+        archive = SimpleUploadedFile('field.zip', buffer.getvalue(), content_type='application/zip')
+
+        response = self.client.post(reverse('predict_disease_batch'), {'archive': archive})
+
+        results = self.read_ndjson(response)
+        self.assertEqual([r['filename'] for r in results], ['field/a.jpg', 'field/b.png'])
+        self.assertTrue(all('disease_name' in r for r in results))
+
+    def test_invalid_archive_is_rejected(self):
+        archive = SimpleUploadedFile('field.zip', b'not a zip', content_type='application/zip')
+        response = self.client.post(reverse('predict_disease_batch'), {'archive': archive})
+        self.assertEqual(response.status_code, 400)
+
+    def make_noise_archive(self, count):
+        # Random pixels don't compress, so the archive is about count * 360 KB
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zf:
+            for i in range(count):
+                image = Image.frombytes('RGB', (400, 300), os.urandom(400 * 300 * 3))
+                png = io.BytesIO()
+                image.save(png, format='PNG')
+                zf.writestr(f'noise{i}.png', png.getvalue())
+        return buffer.getvalue()
+
+    def test_raw_zip_body_larger_than_data_upload_limit(self):
+        body = self.make_noise_archive(8)
+        self.assertGreater(len(body), settings.DATA_UPLOAD_MAX_MEMORY_SIZE)
+
+        response = self.client.post(reverse('predict_disease_batch'), body, content_type='application/zip')
+
+        self.assertEqual(response.status_code, 200)
+        results = self.read_ndjson(response)
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all('disease_name' in r for r in results))
+
+    def test_raw_zip_body_over_batch_limit_is_rejected(self):
+        body = self.make_noise_archive(2)
+        with self.settings(CROP_DISEASE_BATCH_MAX_BYTES=len(body) - 1):
+            response = self.client.post(reverse('predict_disease_batch'), body, content_type='application/zip')
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('error', response.json())
+
+    def test_more_images_than_django_default_file_limit(self):
+        data = make_image_bytes(size=(32, 32))
+        uploads = [SimpleUploadedFile(f'leaf{i}.jpg', data, content_type='image/jpeg') for i in range(101)]
+
+        response = self.client.post(reverse('predict_disease_batch'), {'images': uploads})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.read_ndjson(response)), 101)
+
+    def test_too_many_files_is_a_json_error(self):
+        uploads = [SimpleUploadedFile(f'leaf{i}.jpg', b'x', content_type='image/jpeg') for i in range(4)]
+        with self.settings(DATA_UPLOAD_MAX_NUMBER_FILES=3):
+            response = self.client.post(reverse('predict_disease_batch'), {'images': uploads})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+
+    def test_oversized_images_are_reported_in_place(self):
+        uploads = [
+            SimpleUploadedFile('small.jpg', make_image_bytes(size=(32, 32)), content_type='image/jpeg'),
+            SimpleUploadedFile('wide.jpg', make_image_bytes(size=(320, 240)), content_type='image/jpeg'),
+            SimpleUploadedFile('small.png', make_image_bytes(size=(32, 32), format='PNG'), content_type='image/png'),
+        ]
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zf:
+            zf.writestr('field/wide.jpg', make_image_bytes(size=(320, 240)))
+            zf.writestr('field/small.jpg', make_image_bytes(size=(32, 32)))
+        archive = SimpleUploadedFile('field.zip', buffer.getvalue(), content_type='application/zip')
+
+        with override_settings(CROP_DISEASE_UPLOAD_MAX_PIXELS=100 * 100):
+            response = self.client.post(reverse('predict_disease_batch'), {'images': uploads, 'archive': archive})
+            results = self.read_ndjson(response)
+
+        self.assertEqual(
+            [r['filename'] for r in results],
+            ['small.jpg', 'wide.jpg', 'small.png', 'field/wide.jpg', 'field/small.jpg']
+        )
+        self.assertEqual(results[1]['error'], 'Image has more than 10000 pixels')
+        self.assertEqual(results[3]['error'], 'Image has more than 10000 pixels')
+        for i in (0, 2, 4):
+            self.assertIn('disease_name', results[i])
+
+    def test_image_over_byte_limit_is_reported_in_place(self):
+        data = make_image_bytes(size=(32, 32))
+        uploads = [
+            SimpleUploadedFile('small.jpg', data, content_type='image/jpeg'),
+            SimpleUploadedFile('large.jpg', make_image_bytes(size=(320, 240)), content_type='image/jpeg'),
+        ]
+        with override_settings(CROP_DISEASE_UPLOAD_MAX_BYTES=len(data) + 100):
+            response = self.client.post(reverse('predict_disease_batch'), {'images': uploads})
+
+        results = self.read_ndjson(response)
+        self.assertIn('disease_name', results[0])
+        self.assertEqual(results[1]['filename'], 'large.jpg')
+        self.assertIn('bytes', results[1]['error'])
+
+    def test_archive_members_over_byte_limit_are_reported(self):
+        small, large = make_image_bytes(size=(32, 32)), make_image_bytes(size=(320, 240))
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zf:
+            zf.writestr('small.jpg', small)
+            zf.writestr('large.jpg', large)
+
+        for max_bytes, errors in ((len(small) + 100, 1), (0, 0)):
+            archive = SimpleUploadedFile('field.zip', buffer.getvalue(), content_type='application/zip')
+            with override_settings(CROP_DISEASE_UPLOAD_MAX_BYTES=max_bytes):
+                response = self.client.post(reverse('predict_disease_batch'), {'archive': archive})
+                results = self.read_ndjson(response)
+            self.assertEqual(sum('error' in r for r in results), errors)
+        self.assertIn('disease_name', results[1])
+
+    def test_batch_over_total_byte_limit_is_rejected(self):
+        data = make_image_bytes()
+        # Stopped while streaming in, during the first image and during the third
+        for max_bytes in (1000, 2 * len(data)):
+            uploads = [SimpleUploadedFile(f'leaf{i}.jpg', data, content_type='image/jpeg') for i in range(3)]
+            with override_settings(CROP_DISEASE_BATCH_MAX_BYTES=max_bytes):
+                response = self.client.post(reverse('predict_disease_batch'), {'images': uploads})
+            self.assertEqual(response.status_code, 413)
+            self.assertIn('Batch is larger', response.json()['error'])
+
+
+class BenchmarkInferenceCommandTests(PredictionViewTestMixin, SimpleTestCase):
+    def test_runs_every_stage_with_stub_model(self):
+        out = io.StringIO()
+        call_command(
+            'benchmark_inference', '--stub-model', '--json', '--iterations', '3',
+            '--resolutions', '96x64', '--concurrency', '1,2', stdout=out, stderr=io.StringIO(),
+        )
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(
+            {row['stage'] for row in rows}, {'decode', 'model', 'postprocess', 'endpoint'}
+        )
+        self.assertEqual({row['concurrency'] for row in rows}, {1, 2})
+        for row in rows:
+            self.assertEqual(row['count'], 3)
+            self.assertLessEqual(row['p50_ms'], row['p99_ms'])
+
+
+class PredictionHistoryRecordingTests(PredictionViewTestMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.recorder = HistoryRecorder(flush_size=10, flush_interval=0.01)
+        self.addCleanup(self.recorder.close)
+        self.enterContext(mock.patch('CropDisease.views.history_recorder', self.recorder))
+        self.user = get_user_model().objects.create_user(
+            username='grower@example.com', email='grower@example.com', password='secret',
+        )
+
+    def post_image(self, url_name='predict_disease', token=None, upload=None):
+        upload = upload or SimpleUploadedFile('leaf.jpg', make_image_bytes(), content_type='image/jpeg')
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'} if token else {}
+        return self.client.post(reverse(url_name), {'image': upload}, **headers)
+
+    def test_authenticated_predictions_are_written_behind(self):
+        token = AccessToken.for_user(self.user)
+        first = self.post_image(token=token)
+        second = self.post_image('predict_disease_async', token=token)
+        self.post_image()  # Anonymous: not recorded
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+
+        # Shutdown writes whatever is still queued
+        self.recorder.close()
+        rows = list(PredictionHistory.objects.all())
+        self.assertEqual(len(rows), 2)
+        for row in rows:
+            self.assertEqual(row.user, self.user)
+            self.assertEqual(row.disease, first.json()['disease_name'])
+            self.assertTrue(os.path.exists(row.image.path))
+        self.assertEqual(self.recorder.stats()['written'], 2)
+        # Counted in the daily rollups by the same flush
+        counts = UserDiseaseDailyCount.objects.get(user=self.user)
+        self.assertEqual((counts.disease, counts.count), (rows[0].disease, 2))
+
+    def test_stored_name_comes_from_the_image_format(self):
+        token = AccessToken.for_user(self.user)
+        uploads = [
+            SimpleUploadedFile('x.html', make_image_bytes(format='GIF'), content_type='text/html'),
+            SimpleUploadedFile('y.svg', make_image_bytes(color=(1, 2, 3)), content_type='image/svg+xml'),
+        ]
+        for upload in uploads:
+            self.assertEqual(self.post_image(token=token, upload=upload).status_code, 200)
+        self.recorder.close()
+
+        extensions = {os.path.splitext(row.image.name)[1] for row in PredictionHistory.objects.all()}
+        self.assertEqual(extensions, {'.jpg', '.png'})
+        with Image.open(PredictionHistory.objects.get(image__endswith='.png').image.path) as image:
+            self.assertEqual(image.format, 'PNG')
+
+    def test_session_user_is_recorded(self):
+        self.client.force_login(self.user)
+        self.post_image()
+        self.recorder.close()
+        self.assertEqual(PredictionHistory.objects.filter(user=self.user).count(), 1)
+
+    def test_records_of_deleted_users_do_not_block_the_batch(self):
+        self.recorder.record(self.user.pk, make_image_bytes(), 'Tomato___healthy', 99.0)
+        self.recorder.record(self.user.pk + 1000, make_image_bytes(), 'Tomato___healthy', 99.0)
+        self.recorder.close()
+        self.assertEqual(PredictionHistory.objects.count(), 1)
+        self.assertEqual(self.recorder.stats()['failed'], 1)
+        self.assertFalse(self.recorder.record(self.user.pk, b'', 'Tomato___healthy', 99.0))
+
+    def test_queue_is_bounded_by_image_bytes(self):
+        data = make_image_bytes()
+        recorder = HistoryRecorder(flush_size=100, flush_interval=60, max_queue_bytes=2 * len(data) + 1)
+        self.addCleanup(recorder.close)
+        accepted = [recorder.record(self.user.pk, data, 'Tomato___healthy', 99.0) for i in range(3)]
+        self.assertEqual(accepted, [True, True, False])
+        self.assertEqual(recorder.stats()['queued_bytes'], 2 * len(data))
+        self.assertEqual(recorder.stats()['dropped'], 1)
+
+        recorder.close()
+        self.assertEqual(PredictionHistory.objects.count(), 2)
+        self.assertEqual(recorder.stats()['queued_bytes'], 0)
+
+
+class ModelReloadViewTests(TestCase):
+    def test_only_staff_can_reload(self):
+        users = get_user_model().objects
+        staff = users.create_user(username='ops@example.com', email='ops@example.com', password='x', is_staff=True)
+        grower = users.create_user(username='grower@example.com', email='grower@example.com', password='x')
+        with mock.patch.object(registry, 'reload', return_value=True) as reload:
+            denied = self.client.post(reverse('model_reload'),
+                                      HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(grower)}')
+            self.assertEqual(denied.status_code, 403)
+            reload.assert_not_called()
+            response = self.client.post(reverse('model_reload'),
+                                        HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(staff)}')
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.json()['started'])
+        reload.assert_called_once_with()
+
+
+class PredictionHistoryViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = get_user_model().objects
+        cls.user = users.create_user(username='grower@example.com', email='grower@example.com', password='x')
+        other = users.create_user(username='other@example.com', email='other@example.com', password='x')
+        start = datetime.datetime(2026, 5, 1, 8, tzinfo=datetime.timezone.utc)
+        rows = PredictionHistory.objects.bulk_create(
+            PredictionHistory(user=cls.user, image=f'prediction_images/{i}.jpg', confidence=90.0,
+                              disease='Tomato___Late_blight' if i % 3 == 0 else 'Tomato___healthy')
+            for i in range(25)
+        )
+        # Twelve hours apart; 20 and 21 share a timestamp to exercise the tie-breaker
+        for i, row in enumerate(rows):
+            hours = 12 * (i if i != 21 else 20)
+            PredictionHistory.objects.filter(pk=row.pk).update(created_at=start + datetime.timedelta(hours=hours))
+        PredictionHistory.objects.create(user=other, image='prediction_images/x.jpg',
+                                         disease='Tomato___healthy', confidence=80.0)
+
+    def setUp(self):
+        self.headers = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+
+    def fetch_all(self, **params):
+        url = reverse('prediction_history')
+        pages = []
+        response = self.client.get(url, dict(params, page_size=7), **self.headers)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.json()['results'])
+            next_url = response.json()['next']
+            if not next_url:
+                return pages
+            response = self.client.get(next_url, **self.headers)
+
+    def test_pages_cover_every_record_newest_first(self):
+        pages = self.fetch_all()
+        self.assertEqual([len(page) for page in pages], [7, 7, 7, 4])
+        records = [record for page in pages for record in page]
+        self.assertEqual(len({record['id'] for record in records}), 25)
+        keys = [(record['created_at'], record['id']) for record in records]
+        self.assertEqual(keys, sorted(keys, reverse=True))
+
+    def test_filters_by_disease_and_date_range(self):
+        blight = [r for page in self.fetch_all(disease='Tomato___Late_blight') for r in page]
+        self.assertEqual(len(blight), 9)
+        self.assertTrue(all(r['disease'] == 'Tomato___Late_blight' for r in blight))
+
+        # 2026-05-02 holds records 2 and 3; 05-03 holds 4 and 5
+        in_range = [r for page in self.fetch_all(date_from='2026-05-02', date_to='2026-05-03') for r in page]
+        self.assertEqual(len(in_range), 4)
+
+    def test_invalid_date_is_rejected(self):
+        response = self.client.get(reverse('prediction_history'), {'date_from': 'May'}, **self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_requires_authentication(self):
+        self.assertEqual(self.client.get(reverse('prediction_history')).status_code, 401)
+
+    def test_pages_are_index_range_scans(self):
+        plan = PredictionHistory.objects.filter(user=self.user).order_by('-created_at', '-id')[:20].explain()
+        self.assertIn('history_user_created_idx', plan)
+        plan = (PredictionHistory.objects.filter(user=self.user, disease='Tomato___healthy')
+                .order_by('-created_at', '-id')[:20].explain())
+        self.assertIn('history_user_disease_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class DiseaseStatsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        users = get_user_model().objects
+        cls.user = users.create_user(username='grower@example.com', email='grower@example.com', password='x')
+        cls.other = users.create_user(username='other@example.com', email='other@example.com', password='x')
+        cls.rows = []
+        for user, day, disease in [
+            (cls.user, 1, 'Tomato___healthy'), (cls.user, 1, 'Tomato___healthy'),
+            (cls.user, 2, 'Tomato___Late_blight'), (cls.other, 1, 'Tomato___healthy'),
+            (cls.other, 3, 'Potato___Early_blight'),
+        ]:
+            row = PredictionHistory.objects.create(user=user, image='prediction_images/x.jpg',
+                                                   disease=disease, confidence=70.0)
+            row.created_at = datetime.datetime(2026, 5, day, 23, 30, tzinfo=datetime.timezone.utc)
+            row.save(update_fields=['created_at'])
+            cls.rows.append(row)
+
+    def get_stats(self, **params):
+        token = AccessToken.for_user(self.user)
+        response = self.client.get(reverse('disease_stats'), params, HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_incremental_counts_match_rebuild(self):
+        add_to_rollups(self.rows[:3])
+        add_to_rollups(self.rows[3:])
+        incremental = sorted(DiseaseDailyCount.objects.values_list('day', 'disease', 'count'))
+        user_incremental = sorted(UserDiseaseDailyCount.objects.values_list('user', 'day', 'disease', 'count'))
+
+        call_command('rebuild_disease_stats', stdout=io.StringIO())
+        self.assertEqual(sorted(DiseaseDailyCount.objects.values_list('day', 'disease', 'count')), incremental)
+        self.assertEqual(
+            sorted(UserDiseaseDailyCount.objects.values_list('user', 'day', 'disease', 'count')), user_incremental
+        )
+        self.assertIn((datetime.date(2026, 5, 1), 'Tomato___healthy', 3), incremental)
+
+    def test_stats_api_reads_user_and_global_rollups(self):
+        call_command('rebuild_disease_stats', stdout=io.StringIO())
+        mine = self.get_stats()
+        self.assertEqual(mine['totals'], {'Tomato___healthy': 2, 'Tomato___Late_blight': 1})
+        self.assertEqual(mine['days'][0], {'day': '2026-05-01', 'disease': 'Tomato___healthy', 'count': 2})
+
+        everyone = self.get_stats(scope='global', date_from='2026-05-01', date_to='2026-05-02')
+        self.assertEqual(everyone['totals'], {'Tomato___healthy': 3, 'Tomato___Late_blight': 1})
+        # Authentication looks the user up; the stats themselves are one rollup read
+        with CaptureQueriesContext(connection) as queries:
+            self.get_stats(scope='global', disease='Potato___Early_blight')
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('predictionhistory', queries[1]['sql'].lower())
+
+
+class BulkScanCommandTests(PredictionViewTestMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        self.root = os.path.join(temp.name, 'photos')
+        os.makedirs(os.path.join(self.root, 'field-b'))
+        os.makedirs(os.path.join(self.root, 'field-a'))
+        for i, folder in enumerate(['field-a', 'field-a', 'field-b', 'field-b', 'field-b']):
+            with open(os.path.join(self.root, folder, f'{i}.jpg'), 'wb') as f:
+                f.write(make_image_bytes(color=(i * 40, 120, 60)))
+        with open(os.path.join(self.root, 'field-b', 'broken.jpg'), 'wb') as f:
+            f.write(b'not an image')
+        with open(os.path.join(self.root, 'notes.txt'), 'w') as f:
+            f.write('ignored')
+        self.output = os.path.join(temp.name, 'scan.jsonl')
+
+    def scan(self, *args):
+        call_command('bulk_scan', self.root, self.output, '--batch-size', '2', *args, stdout=io.StringIO())
+        with open(self.output) as f:
+            return f.read()
+
+    def test_decode_workers_do_not_set_up_django(self):
+        # Spawned decode workers must not run Django's startup (or its model preloading)
+        env = {k: v for k, v in os.environ.items() if k != 'DJANGO_SETTINGS_MODULE'}
+        script = (
+            'import sys; from CropDisease.scan import decode_chunk; '
+            f'batch, errors = decode_chunk({self.root!r}, ["field-a/0.jpg", "field-b/broken.jpg"], (32, 32), False); '
+            'from django.conf import settings; '
+            'print(batch.shape, sorted(errors), settings.configured, "CropDisease.views" in sys.modules)'
+        )
+        output = subprocess.run(
+            [sys.executable, '-c', script], cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        self.assertEqual(output.strip(), '(2, 32, 32, 3) [1] False False')
+
+    def test_writes_one_record_per_image_in_stable_order(self):
+        records = [json.loads(line) for line in self.scan('--workers', '0', '--top-k', '2').splitlines()]
+        self.assertEqual([r['path'] for r in records], [
+            os.path.join('field-a', '0.jpg'), os.path.join('field-a', '1.jpg'),
+            os.path.join('field-b', '2.jpg'), os.path.join('field-b', '3.jpg'),
+            os.path.join('field-b', '4.jpg'), os.path.join('field-b', 'broken.jpg'),
+        ])
+        self.assertIn('error', records[-1])
+        self.assertEqual(len(records[0]['top_k']), 2)
+        self.assertIn(records[0]['disease_name'], registry.class_names)
+
+    def test_resume_continues_after_last_checkpoint(self):
+        complete = self.scan('--workers', '0')
+        # Pretend the scan died after the first batch, halfway through writing the second
+        checkpoint_path = self.output + '.checkpoint'
+        with open(checkpoint_path) as f:
+            state = json.load(f)
+        lines = complete.splitlines(keepends=True)
+        state.update(done=2, errors=0, last_path=json.loads(lines[1])['path'],
+                     output_bytes=len(''.join(lines[:2]).encode()))
+        with open(checkpoint_path, 'w') as f:
+            json.dump(state, f)
+        with open(self.output, 'w') as f:
+            f.write(''.join(lines[:2]) + lines[2][:10])
+
+        self.assertEqual(self.scan('--workers', '0', '--resume'), complete)
+        self.assertEqual(len(self.model.batch_sizes), registry.warmup_runs + 3 + 2)
+
+    def test_csv_output_with_decode_processes(self):
+        self.output = self.output.replace('.jsonl', '.csv')
+        rows = list(csv.DictReader(io.StringIO(self.scan('--workers', '2'))))
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[-1]['disease_name'], '')
+        self.assertTrue(rows[-1]['error'])
+        self.assertTrue(rows[0]['disease_name'])
+
+
+class ImportBudgetTests(SimpleTestCase):
+    """
+    ``django.setup()`` plus URL resolution must stay cheap: management commands,
+    the admin and Account-only workers never run inference.
+    """
+
+    budget_seconds = float(os.environ.get('PLANTIFY_IMPORT_BUDGET_SECONDS', 3.0))
+
+    def measure(self):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='Plantify.settings')
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_BUDGET_SCRIPT],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+    def test_startup_does_not_import_inference_libraries(self):
+        self.assertEqual(self.measure()['modules'], [])
+
+    def test_setup_does_not_preload_the_model(self):
+        # Preloading is for server processes (wsgi.py / asgi.py), not every process that sets up Django
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='Plantify.settings', CROP_DISEASE_PRELOAD_MODEL='True',
+                   CROP_DISEASE_MODEL_WATCH_INTERVAL='60')
+        script = (
+            'import django, threading; django.setup(); import CropDisease.views; '
+            'print(sorted(thread.name for thread in threading.enumerate()))'
+        )
+        output = subprocess.run(
+            [sys.executable, '-c', script], cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        self.assertEqual(output.strip(), "['MainThread']")
+
+    def test_server_processes_preload_the_model(self):
+        with override_settings(CROP_DISEASE_PRELOAD_MODEL=True, CROP_DISEASE_MODEL_WATCH_INTERVAL=60), \
+                mock.patch.object(registry, 'load_in_background') as load, \
+                mock.patch.object(registry, 'watch') as watch:
+            start_serving()
+        load.assert_called_once_with()
+        watch.assert_called_once_with(60)
+
+    def test_startup_within_budget(self):
+        # Best of three to keep a noisy CI machine from failing the build
+        seconds = min(self.measure()['seconds'] for _ in range(3))
+        self.assertLess(seconds, self.budget_seconds)
@@ -0,0 +1,54 @@
+def build_augmentations(image, crop_fraction=0.875):
+    """
+    Test-time augmentations of one preprocessed image, as a single batch.
+
+    Returns horizontal and vertical flips plus four corner crops and a centre
+    crop covering ``crop_fraction`` of each side, resized back to the input
+    size by nearest-neighbour index mapping (no per-image resampling calls).
+
+    Args:
+        image: array of shape (height, width, channels)
+
+    Returns:
+        array of shape (7, height, width, channels)
+    """
+    import numpy as np
+
+    height, width = image.shape[:2]
+    crop_height = max(1, int(round(height * crop_fraction)))
+    crop_width = max(1, int(round(width * crop_fraction)))
+    rows = np.linspace(0, crop_height - 1, height).round().astype(int)[:, None]
+    cols = np.linspace(0, crop_width - 1, width).round().astype(int)[None, :]
+    offsets = [
+        (0, 0),
+        (0, width - crop_width),
+        (height - crop_height, 0),
+        (height - crop_height, width - crop_width),
+        ((height - crop_height) // 2, (width - crop_width) // 2),
+    ]
+
+    batch = np.empty((2 + len(offsets),) + image.shape, dtype=image.dtype)
+    batch[0] = image[:, ::-1]
+    batch[1] = image[::-1]
+    for i, (top, left) in enumerate(offsets, start=2):
+        batch[i] = image[top + rows, left + cols]
+    return batch
+
+
+def predict_with_tta(model, image, predictions):
+    """
+    Average ``predictions`` (the model output for ``image``) with the outputs
+    for every augmentation of it, scored in one batched model call.
+
+    Args:
+        image: preprocessed batch of one image, shape (1, height, width, channels)
+        predictions: model output for ``image``, shape (1, classes)
+
+    Returns:
+        array of shape (1, classes)
+    """
+    import numpy as np
+
+    augmented = model.predict(build_augmentations(image[0]))
+    total = np.asarray(predictions[0], dtype='float64') + np.asarray(augmented, dtype='float64').sum(axis=0)
+    return (total / (len(augmented) + 1))[None, :]
@@ -0,0 +1,239 @@
+import io
+import tempfile
+import threading
+import warnings
+from collections import Counter
+
+from django.conf import settings
+from django.core.files.uploadedfile import InMemoryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopUpload
+from PIL import Image
+
+from .metrics import metrics
+
+# Allowance for multipart boundaries, part headers and the other form fields
+# when checking Content-Length against the file size limit
+MULTIPART_OVERHEAD = 64 * 1024
+# Stop looking for the image size while the upload streams in after this many
+# bytes; file_complete tries once more on the whole file
+MAX_HEADER_BYTES = 1024 * 1024
+
+_rejections = Counter()
+_rejections_lock = threading.Lock()
+
+
+def count_rejection(reason):
+    with _rejections_lock:
+        _rejections[reason] += 1
+
+
+class UploadRejected(Exception):
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def read_image_size(file, max_pixels):
+    # (width, height) from the image header, or None if it can't be parsed (yet).
+    # Image.open only parses the header; the pixels aren't decoded or even
+    # allocated until load()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            size = Image.open(file).size
+    except Image.DecompressionBombError:
+        # PIL refuses anything over twice its own MAX_IMAGE_PIXELS, whatever max_pixels is
+        raise UploadRejected(f'Image has more than {2 * Image.MAX_IMAGE_PIXELS} pixels', 413)
+    except OSError:
+        return None
+    if max_pixels and size[0] * size[1] > max_pixels:
+        raise UploadRejected(f'Image has more than {max_pixels} pixels', 413)
+    return size
+
+
+def check_image_size(data, max_pixels=None):
+    # For image bytes that didn't stream in through ImageUploadHandler, such as
+    # zip archive members: rejects them by their header, before decoding
+    max_pixels = settings.CROP_DISEASE_UPLOAD_MAX_PIXELS if max_pixels is None else max_pixels
+    read_image_size(io.BytesIO(data), max_pixels)
+
+
+def content_length(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+class ImageUploadHandler(FileUploadHandler):
+    """
+    Keeps uploaded images in memory and rejects them while they stream in:
+    files over ``max_bytes``, and images over ``max_pixels`` pixels as soon as
+    the image header has arrived, so neither is ever fully received or decoded.
+
+    The upload is stopped without the file (the rest of the body is read and
+    discarded); ``check_upload`` then raises the reason as UploadRejected.
+
+    Only a WSGI server hands the body over as it arrives. Under ASGI Django has
+    received the whole request before the view runs, so there the limits keep
+    a rejected image from being buffered again and decoded, not from being sent.
+    """
+
+    def __init__(self, request=None, max_bytes=None, max_pixels=None):
+        super().__init__(request)
+        self.max_bytes = settings.CROP_DISEASE_UPLOAD_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_pixels = settings.CROP_DISEASE_UPLOAD_MAX_PIXELS if max_pixels is None else max_pixels
+        self.rejection = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file = io.BytesIO()
+        self.size = None  # (width, height) once the header has been read
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+        received = start + len(raw_data)
+        if self.max_bytes and received > self.max_bytes:
+            self.reject(f'Image is larger than {self.max_bytes} bytes', 413, 'bytes')
+        if self.size is None and received <= MAX_HEADER_BYTES:
+            self.read_header()
+
+    def read_header(self):
+        # Image.open only parses the header; the pixels aren't decoded or
+        # even allocated until load()
+        self.file.seek(0)
+        try:
+            self.size = read_image_size(self.file, self.max_pixels)  # None: not enough of it yet
+        except UploadRejected as e:
+            self.reject(str(e), e.status, 'pixels')
+        self.file.seek(0, io.SEEK_END)
+
+    def reject(self, message, status, reason):
+        self.file.close()
+        count_rejection(reason)
+        self.stop(UploadRejected(message, status))
+
+    def stop(self, rejection):
+        self.rejection = rejection
+        raise StopUpload(connection_reset=False)
+
+    def file_complete(self, file_size):
+        if self.size is None:
+            # A header that ends past MAX_HEADER_BYTES, e.g. after a large ICC profile
+            self.read_header()
+        if self.size is None:
+            self.reject('Unrecognized image format', 400, 'format')
+        self.file.seek(0)
+        return InMemoryUploadedFile(
+            file=self.file,
+            field_name=self.field_name,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+        )
+
+
+class BatchUploadHandler(ImageUploadHandler):
+    """
+    ImageUploadHandler for batch requests. An image over the limits is skipped
+    rather than stopping the upload, and listed in ``skipped`` as
+    ``(position, filename, UploadRejected)`` so it is still reported in its
+    place among the 'images'. The 'archive' file goes to a temporary file
+    without the image checks. The upload as a whole is stopped once more than
+    ``max_total_bytes`` have arrived.
+    """
+
+    def __init__(self, request=None, max_total_bytes=None, **kwargs):
+        super().__init__(request, **kwargs)
+        self.max_total_bytes = settings.CROP_DISEASE_BATCH_MAX_BYTES if max_total_bytes is None else max_total_bytes
+        self.received = 0
+        self.images_seen = 0
+        self.skipped = []
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        if field_name == 'archive':
+            self.file = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        elif field_name == 'images':
+            self.position = self.images_seen
+            self.images_seen += 1
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.max_total_bytes and self.received > self.max_total_bytes:
+            self.file.close()
+            count_rejection('bytes')
+            super().stop(UploadRejected(f'Batch is larger than {self.max_total_bytes} bytes', 413))
+        if self.field_name == 'archive':
+            self.file.write(raw_data)
+        else:
+            super().receive_data_chunk(raw_data, start)
+
+    def stop(self, rejection):
+        if self.field_name == 'images':
+            self.skipped.append((self.position, self.file_name, rejection))
+        raise SkipFile()
+
+    def file_complete(self, file_size):
+        if self.field_name != 'archive' and self.size is None:
+            try:
+                self.read_header()
+            except SkipFile:
+                return None  # Over the pixel limit, and listed in skipped
+        if self.field_name != 'archive' and self.size is not None:
+            return super().file_complete(file_size)
+        # The archive, or an image of unknown format, which the batch reports
+        # when it fails to decode
+        self.file.seek(0)
+        return UploadedFile(
+            file=self.file,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+        )
+
+
+def use_image_upload_handler(request):
+    """
+    Parse the request's uploads with ImageUploadHandler. Raises UploadRejected
+    at once if Content-Length alone is too large, without reading the body.
+    """
+    handler = ImageUploadHandler(request)
+    if handler.max_bytes and content_length(request) > handler.max_bytes + MULTIPART_OVERHEAD:
+        count_rejection('bytes')
+        raise UploadRejected(f'Image is larger than {handler.max_bytes} bytes', 413)
+    request.upload_handlers = [handler]
+
+
+def use_batch_upload_handler(request):
+    # As use_image_upload_handler, with BatchUploadHandler
+    handler = BatchUploadHandler(request)
+    if handler.max_total_bytes and content_length(request) > handler.max_total_bytes + MULTIPART_OVERHEAD:
+        count_rejection('bytes')
+        raise UploadRejected(f'Batch is larger than {handler.max_total_bytes} bytes', 413)
+    request.upload_handlers = [handler]
+
+
+def check_upload(request):
+    # Raises the reason an upload was stopped by ImageUploadHandler, if it was
+    for handler in request.upload_handlers:
+        if getattr(handler, 'rejection', None) is not None:
+            raise handler.rejection
+
+
+def skipped_uploads(request):
+    # (position, filename, UploadRejected) for the images BatchUploadHandler skipped
+    return [skipped for handler in request.upload_handlers for skipped in getattr(handler, 'skipped', ())]
+
+
+@metrics.register_collector
+def collect_upload_metrics():
+    with _rejections_lock:
+        samples = [({'reason': reason}, count) for reason, count in sorted(_rejections.items())]
+    return [
+        ('plantify_upload_rejected_total', 'counter', 'Uploads rejected before being fully received.', samples),
+    ]
@@ -1,6 +1,19 @@
 from django.urls import path
-from .views import predict_disease
+from .views import (
+    predict_disease, predict_disease_async, predict_disease_batch,
+    batching_stats, cache_stats, executor_stats, model_ready,
+    DiseaseStatsView, ModelReloadView, PredictionHistoryView,
+)
 
 urlpatterns = [
     path('predict/', predict_disease, name='predict_disease'),
+    path('predict/async/', predict_disease_async, name='predict_disease_async'),
+    path('predict/batch/', predict_disease_batch, name='predict_disease_batch'),
+    path('batching/stats/', batching_stats, name='batching_stats'),
+    path('cache/stats/', cache_stats, name='cache_stats'),
+    path('executor/stats/', executor_stats, name='executor_stats'),
+    path('ready/', model_ready, name='model_ready'),
+    path('model/reload/', ModelReloadView.as_view(), name='model_reload'),
+    path('history/', PredictionHistoryView.as_view(), name='prediction_history'),
+    path('stats/', DiseaseStatsView.as_view(), name='disease_stats'),
 ]
\ No newline at end of file
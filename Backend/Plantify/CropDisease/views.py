@@ -1,77 +1,526 @@
-import os
+import asyncio
+import contextvars
+import datetime
+import functools
 import json
-import numpy as np 
-from PIL import Image
-import tensorflow as tf
-from django.http import JsonResponse
+import os
+import tempfile
+import zipfile
+from django.conf import settings
+from django.core.exceptions import TooManyFilesSent
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from rest_framework import status
+from rest_framework.pagination import CursorPagination
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from .cache import prediction_cache
+from .cascade import predict_cascade
+from .crops import UnknownCrop, restrict_predictions
+from .executor import inference_executor
+from .history import history_recorder
+from .metrics import annotate_request, metrics, timed_stage, track_request
+from .models import DiseaseDailyCount, PredictionHistory, UserDiseaseDailyCount
+from .postprocess import postprocess_predictions
+from .preprocess import load_and_preprocess_image
+from .registry import registry, NOT_LOADED
+from .scan import IMAGE_EXTENSIONS
+from .serializers import PredictionHistorySerializer
+from .tta import predict_with_tta
+from .uploads import (
+    UploadRejected, check_image_size, check_upload, content_length, skipped_uploads, use_batch_upload_handler,
+    use_image_upload_handler,
+)
+
+def predict_image_class(model, image, class_names, top_k=None, min_confidence=None, tta_threshold=None,
+                        cascade=None, classes=None):
+    # With a cascade its light model answers first and `model` only runs if
+    # that answer isn't confident enough. With `classes` (a crop's) only those
+    # can be predicted. Below tta_threshold (percent) top-1 confidence, the
+    # prediction is redone as the average over the image and its flips and crops
+    try:
+        preprocessed_img = load_and_preprocess_image(image)
+        predictions, escalated = predict_cascade(model, preprocessed_img, cascade, classes)
+        with timed_stage('postprocess'):
+            result = postprocess_predictions(predictions, class_names, top_k, min_confidence, classes)[0]
+        if cascade is not None:
+            result['escalated'] = bool(escalated[0])
+        if not tta_threshold or result['confidence'] >= tta_threshold:
+            return result
+        with timed_stage('tta'):
+            predictions = predict_with_tta(model, preprocessed_img, predictions)
+            if classes is not None:
+                predictions = restrict_predictions(predictions, classes)
+        with timed_stage('postprocess'):
+            result = postprocess_predictions(predictions, class_names, top_k, min_confidence, classes)[0]
+        result['tta'] = True
+        return result
+    except Exception as e:
+        raise ValueError(f"Error during prediction: {str(e)}")
+
+def parse_prediction_options(request):
+    # Optional 'top_k', 'min_confidence' (percent) and 'crop' (hint, checked
+    # against the model's labels when predicting) from the form or query string
+    options = {}
+    top_k = request.POST.get('top_k') or request.GET.get('top_k')
+    min_confidence = request.POST.get('min_confidence') or request.GET.get('min_confidence')
+    crop = request.POST.get('crop') or request.GET.get('crop')
+    if top_k:
+        try:
+            options['top_k'] = int(top_k)
+        except ValueError:
+            raise ValueError('top_k must be an integer')
+        if not 1 <= options['top_k'] <= settings.CROP_DISEASE_MAX_TOP_K:
+            raise ValueError(f'top_k must be between 1 and {settings.CROP_DISEASE_MAX_TOP_K}')
+    if min_confidence:
+        try:
+            options['min_confidence'] = float(min_confidence)
+        except ValueError:
+            raise ValueError('min_confidence must be a number')
+        if not 0 <= options['min_confidence'] <= 100:
+            raise ValueError('min_confidence must be between 0 and 100')
+    if crop and crop.strip():
+        options['crop'] = crop.strip()
+    return options
 
-# Define working directory and paths
-working_dir = os.path.dirname(os.path.abspath(__file__))
-model_path = os.path.join(working_dir, 'trained_model', 'Plantify_VGG16.h5')
-class_indices_path = os.path.join(working_dir, 'class_indices.json')
+def collect_batch_images(request):
+    # Returns (filename, image) for every multipart 'images' file and every image
+    # inside a zip archive, sent either as the 'archive' field or as the raw body.
+    # Archive members are returned as callables so nothing is decompressed
+    # before the request has been validated.
+    use_batch_upload_handler(request)
+    images = [(upload.name, upload) for upload in request.FILES.getlist('images')]
+    check_upload(request)
+    # Images rejected while streaming in keep their place, as errors
+    for position, name, rejection in skipped_uploads(request):
+        images.insert(position, (name, rejection))
 
-# Load the pre-trained model
-model = tf.keras.models.load_model(model_path)
+    archive = request.FILES.get('archive')
+    if archive is None and request.content_type in ('application/zip', 'application/x-zip-compressed'):
+        archive = read_raw_body(request, settings.CROP_DISEASE_BATCH_MAX_BYTES)
+    if archive is None:
+        return images
 
-# Load the class indices from JSON file
-with open(class_indices_path, 'r') as f:
-    class_indices = json.load(f)
+    # Members over the upload size limit are reported as errors instead of decompressed
+    max_bytes = settings.CROP_DISEASE_UPLOAD_MAX_BYTES
+    zf = zipfile.ZipFile(archive)
+    for info in zf.infolist():
+        if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        if os.path.basename(info.filename).startswith('.'):
+            continue  # macOS resource forks and other hidden files
+        if max_bytes and info.file_size > max_bytes:
+            images.append((info.filename, UploadRejected(f'Image is larger than {max_bytes} bytes', 413)))
+        else:
+            images.append((info.filename, functools.partial(zf.read, info)))
+    return images
 
-def load_and_preprocess_image(image_path, target_size=(224, 224)):
-    try:
-        img = Image.open(image_path)
-        img = img.convert('RGB')  # Ensure image is in RGB format
-        img = img.resize(target_size)
-        img_array = np.array(img)
-        img_array = np.expand_dims(img_array, axis=0)
-        img_array = img_array.astype('float32') / 255.0
-        return img_array
-    except Exception as e:
-        raise ValueError(f"Error processing image: {str(e)}")
+def read_raw_body(request, max_bytes):
+    # request.body is capped at DATA_UPLOAD_MAX_MEMORY_SIZE and held in memory;
+    # the stream is copied into a temporary file (spilling to disk past
+    # FILE_UPLOAD_MAX_MEMORY_SIZE) under a cap of our own instead
+    if content_length(request) > max_bytes:
+        raise UploadRejected(f'Archive is larger than {max_bytes} bytes', 413)
+    body = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+    received = 0
+    while chunk := request.read(64 * 1024):
+        received += len(chunk)
+        if received > max_bytes:
+            body.close()
+            raise UploadRejected(f'Archive is larger than {max_bytes} bytes', 413)
+        body.write(chunk)
+    body.seek(0)
+    return body
 
-def predict_image_class(model, image_path, class_indices):
+def predict_images_in_batches(model, images, class_names, batch_size, target_size=(224, 224), cascade=None,
+                              classes=None, **options):
+    # Decodes images a batch at a time straight into one reusable batch tensor,
+    # runs one model call per batch (two with a cascade, the second for the
+    # images it escalates) and yields one result per input, in input order, as
+    # soon as its batch is done
+    import numpy as np
+
+    width, height = target_size
+    buffer = np.empty((batch_size, height, width, 3), dtype='float32')
+
+    def flush(pending, rows):
+        by_row = {}
+        if rows:
+            try:
+                predictions = predict_cascade(model, buffer[:rows], cascade, classes)[0]
+                with timed_stage('postprocess'):
+                    by_row = dict(enumerate(postprocess_predictions(predictions, class_names, classes=classes, **options)))
+            except Exception as e:
+                by_row = {row: {'error': f"Error during prediction: {str(e)}"} for row in range(rows)}
+        for i, name, row in pending:
+            result = {'error': str(row)} if isinstance(row, Exception) else by_row[row]
+            yield dict({'index': i, 'filename': name}, **result)
+
+    pending = []
+    rows = 0
+    for i, (name, image) in enumerate(images):
+        try:
+            if isinstance(image, Exception):
+                raise image
+            if callable(image):
+                image = image()
+                # Archive members didn't pass the upload checks on the way in
+                check_image_size(image)
+            load_and_preprocess_image(image, target_size, out=buffer[rows])
+            pending.append((i, name, rows))
+            rows += 1
+        except Exception as e:
+            pending.append((i, name, e))
+        if len(pending) >= batch_size:
+            yield from flush(pending, rows)
+            pending = []
+            rows = 0
+    if pending:
+        yield from flush(pending, rows)
+
+
+def predict_uploaded_image(data, options):
+    # Shared by the sync and async predict views
+    # Loads and warms the model on first use unless it was preloaded. The
+    # request stays on the version it started with if a reload swaps in another
+    with registry.acquire() as active:
+        # A crop hint goes to the crop's own model if there is one, otherwise
+        # the full model's output is restricted to the crop's labels
+        options = dict(options)
+        crop = active.resolve_crop(options.pop('crop', None))
+        head, classes = active.route(crop)
+        # Predict the disease straight from the upload bytes, no temp file.
+        # Identical uploads are answered from the cache, or wait on the
+        # inference already running for them
+        cache_key = prediction_cache.make_key(data, active.version, dict(options, crop=crop) if crop else options)
+        result, cached = prediction_cache.get_or_compute(
+            cache_key,
+            lambda: predict_image_class(head or active.batcher, data, active.class_names,
+                                        tta_threshold=settings.CROP_DISEASE_TTA_THRESHOLD,
+                                        cascade=None if head else active.cascade, classes=classes, **options)
+        )
+    if cached:
+        annotate_request('cache', 'hit')
+    if crop:
+        result = dict(result, crop=crop)
+    return dict(result, cached=cached, model_version=active.version)
+
+
+def token_user_id(request):
+    # User id from a valid JWT access token in the Authorization header. The
+    # token is only validated, so this costs no database query
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+    from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header is not None else None
+    if raw_token is None:
+        return None
     try:
-        preprocessed_img = load_and_preprocess_image(image_path)
-        predictions = model.predict(preprocessed_img)
-        predicted_class_index = np.argmax(predictions[0])
-        confidence = float(predictions[0][predicted_class_index])
-        predicted_class_name = class_indices[str(predicted_class_index)]
-        
-        # Include confidence score in the prediction
-        result = {
-            'disease_name': predicted_class_name,
-            'confidence': round(confidence * 100, 2)
-        }
-        return result
-    except Exception as e:
-        raise ValueError(f"Error during prediction: {str(e)}")
-    
+        return authentication.get_validated_token(raw_token).get(jwt_settings.USER_ID_CLAIM)
+    except (InvalidToken, TokenError):
+        return None
+
+
+def record_prediction(user_id, data, result):
+    # Queued for the background history writer; the response doesn't wait for it
+    if user_id is not None and settings.CROP_DISEASE_HISTORY_ENABLED:
+        history_recorder.record(user_id, data, result['disease_name'], result['confidence'])
+
+
+def read_image_upload(request):
+    # The 'image' upload, kept in memory and size-checked while it streams in
+    use_image_upload_handler(request)
+    image = request.FILES.get('image')
+    check_upload(request)
+    return image
 
 
 @csrf_exempt
 def predict_disease(request):
+    # Stage timings go out in the Server-Timing header and into /metrics
+    with track_request('predict') as timings:
+        timings.response = _predict_disease(request)
+    return timings.response
+
+
+def _predict_disease(request):
     if request.method == 'POST':
         try:
-            image = request.FILES.get('image')
+            try:
+                image = read_image_upload(request)
+            except UploadRejected as e:
+                return JsonResponse({'error': str(e)}, status=e.status)
             if not image:
                 return JsonResponse({'error': 'No image provided'}, status=400)
+            try:
+                options = parse_prediction_options(request)
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+
+            with timed_stage('read'):
+                data = image.read()
+            try:
+                prediction_result = predict_uploaded_image(data, options)
+            except UnknownCrop as e:
+                return JsonResponse({'error': str(e)}, status=400)
 
-            # Save the image temporarily
-            temp_image_path = os.path.join(working_dir, 'temp_image.jpg')
-            with open(temp_image_path, 'wb') as f:
-                for chunk in image.chunks():
-                    f.write(chunk)
-
-            # Predict the disease
-            prediction_result = predict_image_class(model, temp_image_path, class_indices)
-            
-            # Clean up
-            if os.path.exists(temp_image_path):
-                os.remove(temp_image_path)
-            
-            return JsonResponse(prediction_result)
+            user_id = token_user_id(request)
+            if user_id is None and request.user.is_authenticated:
+                user_id = request.user.pk
+            record_prediction(user_id, data, prediction_result)
+
+            with timed_stage('encode'):
+                return JsonResponse(prediction_result)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
-    return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
\ No newline at end of file
+    return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
+
+
+@csrf_exempt
+async def predict_disease_async(request):
+    with track_request('predict_async') as timings:
+        timings.response = await _predict_disease_async(request)
+    return timings.response
+
+
+async def _predict_disease_async(request):
+    # Same contract as predict_disease, but decode and inference run on a bounded
+    # executor so an ASGI server keeps serving other requests meanwhile. The
+    # upload limits still apply, but the body has been received in full by now
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
+
+    try:
+        image = read_image_upload(request)
+    except UploadRejected as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    if not image:
+        return JsonResponse({'error': 'No image provided'}, status=400)
+    try:
+        options = parse_prediction_options(request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    with timed_stage('read'):
+        data = image.read()
+    # The copied context carries this request's stage timings into the worker thread
+    future = inference_executor.try_submit(
+        contextvars.copy_context().run, predict_uploaded_image, data, options
+    )
+    if future is None:
+        # Shed load instead of letting latency grow without bound
+        response = JsonResponse({'error': 'Inference capacity exceeded, please retry'}, status=429)
+        response['Retry-After'] = str(settings.CROP_DISEASE_ASYNC_RETRY_AFTER)
+        return response
+
+    try:
+        prediction_result = await asyncio.wrap_future(future)
+    except UnknownCrop as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+    user_id = token_user_id(request)
+    if user_id is None:
+        user = await request.auser()
+        user_id = user.pk if user.is_authenticated else None
+    record_prediction(user_id, data, prediction_result)
+    with timed_stage('encode'):
+        return JsonResponse(prediction_result)
+
+
+@csrf_exempt
+def predict_disease_batch(request):
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
+
+    too_many = JsonResponse({'error': f'At most {settings.CROP_DISEASE_BATCH_MAX_IMAGES} images per request'},
+                            status=400)
+    try:
+        images = collect_batch_images(request)
+        options = parse_prediction_options(request)
+    except zipfile.BadZipFile:
+        return JsonResponse({'error': 'Invalid zip archive'}, status=400)
+    except UploadRejected as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    except TooManyFilesSent:
+        return too_many
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if not images:
+        return JsonResponse({'error': 'No images provided'}, status=400)
+    if len(images) > settings.CROP_DISEASE_BATCH_MAX_IMAGES:
+        return too_many
+
+    try:
+        registry.load()
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+    try:
+        registry.current.resolve_crop(options.get('crop'))
+    except UnknownCrop as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    # Results are streamed one JSON object per line as each batch completes
+    return StreamingHttpResponse(stream_batch_results(images, options), content_type='application/x-ndjson')
+
+
+def stream_batch_results(images, options):
+    # The whole batch runs on one model version, held until the stream ends
+    with registry.acquire() as active:
+        options = dict(options)
+        crop = active.resolve_crop(options.pop('crop', None))
+        head, classes = active.route(crop)
+        results = predict_images_in_batches(
+            head or active.model, images, active.class_names, settings.CROP_DISEASE_BATCH_MAX_SIZE,
+            cascade=None if head else active.cascade, classes=classes, **options
+        )
+        extra = {'model_version': active.version, **({'crop': crop} if crop else {})}
+        for result in results:
+            yield json.dumps(dict(result, **extra)) + '\n'
+
+
+def batching_stats(request):
+    if request.method == 'GET':
+        active = registry.current
+        if active is None:
+            return JsonResponse({'error': 'Model not loaded'}, status=503)
+        return JsonResponse(dict(active.batcher.stats(), version=active.version))
+    return JsonResponse({'error': 'Only GET requests are allowed'}, status=405)
+
+
+def executor_stats(request):
+    if request.method == 'GET':
+        return JsonResponse(inference_executor.stats())
+    return JsonResponse({'error': 'Only GET requests are allowed'}, status=405)
+
+
+def cache_stats(request):
+    if request.method == 'GET':
+        return JsonResponse(prediction_cache.stats())
+    return JsonResponse({'error': 'Only GET requests are allowed'}, status=405)
+
+
+def model_ready(request):
+    if request.method == 'GET':
+        # A readiness probe on a cold process starts the load so the pod warms up
+        # before it receives traffic
+        if registry.state == NOT_LOADED:
+            registry.load_in_background()
+        status = registry.status()
+        return JsonResponse(status, status=200 if status['ready'] else 503)
+    return JsonResponse({'error': 'Only GET requests are allowed'}, status=405)
+
+
+class ModelReloadView(APIView):
+    # Loads the model files again in the background and swaps the new version
+    # in once it is warm. Only this process reloads; see
+    # CROP_DISEASE_MODEL_WATCH_INTERVAL for every worker picking up new files
+    permission_classes = [IsAdminUser]
+
+    def post(self, request):
+        started = registry.reload()
+        return Response(dict(registry.status(), started=started), status=status.HTTP_202_ACCEPTED)
+
+
+def metrics_view(request):
+    # Prometheus text exposition format
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def parse_date_range(params):
+    # Optional inclusive 'date_from' / 'date_to' (YYYY-MM-DD) query parameters
+    dates = []
+    for name in ('date_from', 'date_to'):
+        value = params.get(name)
+        if not value:
+            dates.append(None)
+            continue
+        try:
+            parsed = parse_date(value)
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise ValueError(f'{name} must be a date (YYYY-MM-DD)')
+        dates.append(parsed)
+    if dates[0] and dates[1] and dates[0] > dates[1]:
+        raise ValueError('date_from must not be after date_to')
+    return dates
+
+
+def day_start(date):
+    # Midnight at the start of ``date`` in the current time zone
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+
+class PredictionHistoryPagination(CursorPagination):
+    # Keyset pagination: each page continues below the last created_at seen
+    # instead of counting past an OFFSET, so deep pages cost the same as the first
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class PredictionHistoryView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        try:
+            date_from, date_to = parse_date_range(request.query_params)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        history = PredictionHistory.objects.filter(user=request.user)
+        disease = request.query_params.get('disease')
+        if disease:
+            history = history.filter(disease=disease)
+        if date_from:
+            history = history.filter(created_at__gte=day_start(date_from))
+        if date_to:
+            history = history.filter(created_at__lt=day_start(date_to + datetime.timedelta(days=1)))
+
+        paginator = PredictionHistoryPagination()
+        page = paginator.paginate_queryset(history, request, view=self)
+        serializer = PredictionHistorySerializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
+
+
+class DiseaseStatsView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        # Reads only the daily rollups: the cost grows with days x diseases in
+        # the range, not with the number of predictions
+        scope = request.query_params.get('scope', 'user')
+        if scope not in ('user', 'global'):
+            return Response({'error': "scope must be 'user' or 'global'"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            date_from, date_to = parse_date_range(request.query_params)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        if scope == 'user':
+            counts = UserDiseaseDailyCount.objects.filter(user=request.user)
+        else:
+            counts = DiseaseDailyCount.objects.all()
+        disease = request.query_params.get('disease')
+        if disease:
+            counts = counts.filter(disease=disease)
+        if date_from:
+            counts = counts.filter(day__gte=date_from)
+        if date_to:
+            counts = counts.filter(day__lte=date_to)
+
+        days = list(counts.order_by('day', 'disease').values('day', 'disease', 'count'))
+        totals = {}
+        for row in days:
+            totals[row['disease']] = totals.get(row['disease'], 0) + row['count']
+        return Response({'scope': scope, 'days': days, 'totals': totals})
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Plantify.settings")
 
 application = get_asgi_application()
+
+# Only server processes preload and watch the crop disease model
+from CropDisease.registry import start_serving  # noqa: E402
+
+start_serving()
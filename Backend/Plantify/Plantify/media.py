@@ -0,0 +1,150 @@
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+from Account.storage import CONTENT_NAME_RE
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def file_etag(path, stat):
+    # Content-addressed files carry the hash of their bytes in their name;
+    # anything else is identified by modification time and size
+    if CONTENT_NAME_RE.search(path):
+        return '"%s"' % os.path.splitext(os.path.basename(path))[0]
+    return '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+
+def parse_range(header, size):
+    """
+    The (start, end) byte positions (inclusive) asked for by a single-range
+    ``Range`` header, None to send the whole file, or False if the range can't
+    be satisfied.
+    """
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if not match:
+        return None  # Unsupported or multiple ranges: ignore the header
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or (last and int(last) < start):
+        return False
+    return start, end
+
+
+def if_range_matches(request, etag, mtime):
+    # If-Range holds an ETag (compared strongly) or a date; a stale one means
+    # the client wants the whole, current file instead of a piece of it
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    since = parse_http_date_safe(if_range)
+    return since is not None and int(mtime) <= since
+
+
+def read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+@require_safe
+def serve_media(request, path):
+    """
+    Serve a file from MEDIA_ROOT with a strong ETag and Last-Modified (answering
+    conditional requests with 304) and single byte ranges.
+
+    With MEDIA_SENDFILE_HEADER set to 'X-Accel-Redirect' (nginx) or
+    'X-Sendfile' (Apache, lighttpd) the body is left to the front-end server,
+    which then also handles ranges.
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('File not found')
+    try:
+        stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404('File not found')
+    if not os.path.isfile(full_path):
+        raise Http404('File not found')
+
+    etag = file_etag(path, stat)
+    content_type = mimetypes.guess_type(full_path)[0]
+    # Only raster images are shown inline; anything else (HTML, SVG, ...) is
+    # downloaded, and sandboxed if a browser renders it anyway, so nothing in
+    # MEDIA_ROOT can run script in our origin
+    inline = bool(content_type) and content_type.startswith('image/') and content_type != 'image/svg+xml'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': (
+            'public, max-age=31536000, immutable' if CONTENT_NAME_RE.search(path)
+            else f'public, max-age={settings.MEDIA_CACHE_MAX_AGE}'
+        ),
+    }
+    if not inline:
+        headers['Content-Disposition'] = 'attachment'
+        headers['Content-Security-Policy'] = 'sandbox'
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if not_modified is not None:
+        for name, value in headers.items():
+            not_modified[name] = value
+        return not_modified
+
+    sendfile_header = settings.MEDIA_SENDFILE_HEADER
+    if sendfile_header:
+        response = HttpResponse(content_type=content_type or 'application/octet-stream', headers=headers)
+        if sendfile_header.lower() == 'x-accel-redirect':
+            response[sendfile_header] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + quote(path)
+        else:
+            response[sendfile_header] = full_path
+        return response
+
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE')
+    if range_header and if_range_matches(request, etag, stat.st_mtime):
+        byte_range = parse_range(range_header, stat.st_size)
+    if byte_range is False:
+        response = HttpResponse(status=416, headers=headers)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+        return response
+    if byte_range is not None:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(
+            read_range(full_path, start, length), status=206,
+            content_type=content_type or 'application/octet-stream', headers=headers,
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        response['Content-Length'] = str(length)
+        return response
+
+    return FileResponse(open(full_path, 'rb'), content_type=content_type, as_attachment=not inline, headers=headers)
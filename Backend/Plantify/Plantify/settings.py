@@ -164,6 +164,22 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 # Media files (Uploaded files)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Media is served by Plantify.media.serve_media. Set MEDIA_SENDFILE_HEADER to
+# 'X-Accel-Redirect' (nginx, with an internal location at
+# MEDIA_ACCEL_REDIRECT_PREFIX aliased to MEDIA_ROOT) or 'X-Sendfile' to have the
+# front-end server send the file body
+MEDIA_SENDFILE_HEADER = os.environ.get('MEDIA_SENDFILE_HEADER') or None
+MEDIA_ACCEL_REDIRECT_PREFIX = os.environ.get('MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+# Browser cache lifetime (seconds) for media that isn't content-addressed
+MEDIA_CACHE_MAX_AGE = int(os.environ.get('MEDIA_CACHE_MAX_AGE', 3600))
+
+# Profile images get square WebP thumbnails of these sizes, generated in the
+# background after upload. Originals larger than PROFILE_IMAGE_MAX_DIMENSION
+# pixels on either side are re-encoded down to it (0 keeps them as uploaded)
+PROFILE_IMAGE_THUMBNAIL_SIZES = (64, 128, 256)
+PROFILE_IMAGE_THUMBNAIL_QUALITY = int(os.environ.get('PROFILE_IMAGE_THUMBNAIL_QUALITY', 80))
+PROFILE_IMAGE_MAX_DIMENSION = int(os.environ.get('PROFILE_IMAGE_MAX_DIMENSION', 0))
+PROFILE_IMAGE_DERIVATIVE_WORKERS = int(os.environ.get('PROFILE_IMAGE_DERIVATIVE_WORKERS', 2))
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
@@ -241,5 +257,97 @@ DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', '')
 if not DEFAULT_FROM_EMAIL and EMAIL_HOST_USER:
     DEFAULT_FROM_EMAIL = f'PlantifyAI <{EMAIL_HOST_USER}>'
 
+# Crop disease inference
+CROP_DISEASE_MODEL_PATH = os.environ.get(
+    'CROP_DISEASE_MODEL_PATH',
+    os.path.join(BASE_DIR, 'CropDisease', 'trained_model', 'Plantify_VGG16.h5')
+)
+CROP_DISEASE_CLASS_INDICES_PATH = os.environ.get(
+    'CROP_DISEASE_CLASS_INDICES_PATH',
+    os.path.join(BASE_DIR, 'CropDisease', 'class_indices.json')
+)
+# Optional compact model (same input and classes as the model above) tried
+# first: only images it is less than CROP_DISEASE_CASCADE_THRESHOLD percent
+# confident about are escalated to the full model
+CROP_DISEASE_LIGHT_MODEL_PATH = os.environ.get('CROP_DISEASE_LIGHT_MODEL_PATH') or None
+CROP_DISEASE_CASCADE_THRESHOLD = float(os.environ.get('CROP_DISEASE_CASCADE_THRESHOLD', 90))
+# Optional directory of per-crop models, named after the crop prefix of the
+# labels (Apple.h5, Corn_(maize).h5, ...) and predicting only that crop's
+# classes in label order. Predictions with a 'crop' hint use the crop's model,
+# or else the full model restricted to the crop's classes. Not supported with
+# CROP_DISEASE_INFERENCE_MODE='process' (loading fails), since every crop
+# model would start its own pool of worker processes
+CROP_DISEASE_CROP_MODELS_DIR = os.environ.get('CROP_DISEASE_CROP_MODELS_DIR') or None
+# Reported with predictions and part of the cache key; derived from the model
+# and class indices files when unset, and always for versions loaded by a reload
+CROP_DISEASE_MODEL_VERSION = os.environ.get('CROP_DISEASE_MODEL_VERSION') or None
+# Serve predictions through a tf.function with a fixed (None, 224, 224, 3) float32
+# signature instead of model.predict, optionally XLA-compiled
+CROP_DISEASE_COMPILED_INFERENCE = os.environ.get('CROP_DISEASE_COMPILED_INFERENCE', 'True') == 'True'
+CROP_DISEASE_XLA_JIT = os.environ.get('CROP_DISEASE_XLA_JIT', 'False') == 'True'
+# Load and warm up the model when a server process starts (wsgi.py / asgi.py)
+# instead of on the first request; management commands never load it
+CROP_DISEASE_PRELOAD_MODEL = os.environ.get('CROP_DISEASE_PRELOAD_MODEL', 'False') == 'True'
+# Every this many seconds, check whether the model or class indices file has
+# been replaced and, if so, load, warm up and swap in the new version while the
+# current one keeps serving (0 disables; staff can also POST to model/reload/)
+CROP_DISEASE_MODEL_WATCH_INTERVAL = float(os.environ.get('CROP_DISEASE_MODEL_WATCH_INTERVAL', 0))
+# Dummy inferences run before the model is reported ready
+CROP_DISEASE_WARMUP_RUNS = int(os.environ.get('CROP_DISEASE_WARMUP_RUNS', 2))
+# Concurrent predictions are grouped into one model call of up to
+# CROP_DISEASE_BATCH_MAX_SIZE images, waiting at most CROP_DISEASE_BATCH_MAX_WAIT_MS
+# for the batch to fill.
+CROP_DISEASE_BATCH_MAX_SIZE = int(os.environ.get('CROP_DISEASE_BATCH_MAX_SIZE', 16))
+CROP_DISEASE_BATCH_MAX_WAIT_MS = float(os.environ.get('CROP_DISEASE_BATCH_MAX_WAIT_MS', 5))
+# 'thread' runs the model inside each web process; 'process' dispatches
+# preprocessed tensors (through shared memory) to CROP_DISEASE_INFERENCE_PROCESSES
+# pre-warmed worker processes. TensorFlow thread pools per worker can be capped
+# with the *_OP_THREADS settings (0 keeps TensorFlow's defaults).
+CROP_DISEASE_INFERENCE_MODE = os.environ.get('CROP_DISEASE_INFERENCE_MODE', 'thread')
+CROP_DISEASE_INFERENCE_PROCESSES = int(os.environ.get('CROP_DISEASE_INFERENCE_PROCESSES', 4))
+CROP_DISEASE_TF_INTRA_OP_THREADS = int(os.environ.get('CROP_DISEASE_TF_INTRA_OP_THREADS', 0))
+CROP_DISEASE_TF_INTER_OP_THREADS = int(os.environ.get('CROP_DISEASE_TF_INTER_OP_THREADS', 0))
+# Decode JPEGs at reduced scale (close to the 224x224 model input) instead of at
+# full resolution; compare against the exact path with benchmarks before enabling
+CROP_DISEASE_FAST_DECODE = os.environ.get('CROP_DISEASE_FAST_DECODE', 'False') == 'True'
+# When the top-1 confidence (percent) of a single-image prediction is below this,
+# flipped and cropped copies are scored in one extra batched call and the
+# probabilities averaged (test-time augmentation); 0 disables it
+CROP_DISEASE_TTA_THRESHOLD = float(os.environ.get('CROP_DISEASE_TTA_THRESHOLD', 0))
+# Images sent to the predict endpoints are kept in memory and rejected with 413
+# as soon as they pass CROP_DISEASE_UPLOAD_MAX_BYTES, or once their header shows
+# more than CROP_DISEASE_UPLOAD_MAX_PIXELS pixels (0 disables either check)
+CROP_DISEASE_UPLOAD_MAX_BYTES = int(os.environ.get('CROP_DISEASE_UPLOAD_MAX_BYTES', 10 * 1024 * 1024))
+CROP_DISEASE_UPLOAD_MAX_PIXELS = int(os.environ.get('CROP_DISEASE_UPLOAD_MAX_PIXELS', 40_000_000))
+# Largest top_k a prediction request may ask for
+CROP_DISEASE_MAX_TOP_K = int(os.environ.get('CROP_DISEASE_MAX_TOP_K', 10))
+# Upper bound on images accepted by one /crop-disease/predict/batch/ request
+CROP_DISEASE_BATCH_MAX_IMAGES = int(os.environ.get('CROP_DISEASE_BATCH_MAX_IMAGES', 500))
+# Django refuses multipart requests carrying more files than this; a batch may
+# send CROP_DISEASE_BATCH_MAX_IMAGES of them plus an archive
+DATA_UPLOAD_MAX_NUMBER_FILES = max(100, CROP_DISEASE_BATCH_MAX_IMAGES + 1)
+# Largest zip archive sent as the raw body of a batch request; it is read from
+# the request stream into a temporary file, not held in memory
+CROP_DISEASE_BATCH_MAX_BYTES = int(os.environ.get('CROP_DISEASE_BATCH_MAX_BYTES', 200 * 1024 * 1024))
+# /crop-disease/predict/async/ runs inference on this many threads with at most
+# CROP_DISEASE_ASYNC_QUEUE_SIZE requests waiting; beyond that it answers 429 with
+# Retry-After set to CROP_DISEASE_ASYNC_RETRY_AFTER seconds
+CROP_DISEASE_ASYNC_WORKERS = int(os.environ.get('CROP_DISEASE_ASYNC_WORKERS', 4))
+CROP_DISEASE_ASYNC_QUEUE_SIZE = int(os.environ.get('CROP_DISEASE_ASYNC_QUEUE_SIZE', 32))
+CROP_DISEASE_ASYNC_RETRY_AFTER = int(os.environ.get('CROP_DISEASE_ASYNC_RETRY_AFTER', 1))
+# Predictions for identical uploads are served from an LRU cache of this many
+# entries (0 disables it)
+CROP_DISEASE_PREDICTION_CACHE_SIZE = int(os.environ.get('CROP_DISEASE_PREDICTION_CACHE_SIZE', 1024))
+# Predictions of signed-in users are saved to PredictionHistory by a background
+# writer: every CROP_DISEASE_HISTORY_FLUSH_INTERVAL seconds or
+# CROP_DISEASE_HISTORY_FLUSH_SIZE records, whichever comes first. Records beyond
+# CROP_DISEASE_HISTORY_MAX_QUEUE waiting ones, or whose image would take the
+# images held for writing past CROP_DISEASE_HISTORY_MAX_QUEUE_BYTES, are dropped
+CROP_DISEASE_HISTORY_ENABLED = os.environ.get('CROP_DISEASE_HISTORY_ENABLED', 'True') == 'True'
+CROP_DISEASE_HISTORY_FLUSH_SIZE = int(os.environ.get('CROP_DISEASE_HISTORY_FLUSH_SIZE', 100))
+CROP_DISEASE_HISTORY_FLUSH_INTERVAL = float(os.environ.get('CROP_DISEASE_HISTORY_FLUSH_INTERVAL', 1.0))
+CROP_DISEASE_HISTORY_MAX_QUEUE = int(os.environ.get('CROP_DISEASE_HISTORY_MAX_QUEUE', 10000))
+CROP_DISEASE_HISTORY_MAX_QUEUE_BYTES = int(os.environ.get('CROP_DISEASE_HISTORY_MAX_QUEUE_BYTES', 256 * 1024 * 1024))
+
 # Add CORS settings
 CORS_ALLOW_ALL_ORIGINS = True  # For development only
\ No newline at end of file
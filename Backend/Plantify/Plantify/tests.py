@@ -0,0 +1,74 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+
+
+class ServeMediaTests(SimpleTestCase):
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name, MEDIA_SENDFILE_HEADER=None))
+        os.makedirs(os.path.join(media.name, 'profile_pics', 'ab'))
+        self.name = 'profile_pics/ab/' + 'ab' * 32 + '.jpg'
+        with open(os.path.join(media.name, self.name), 'wb') as f:
+            f.write(self.content)
+
+    def get(self, path=None, **headers):
+        return self.client.get('/media/' + (path or self.name), **headers)
+
+    def test_full_response_with_validators(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['ETag'], '"%s"' % ('ab' * 32))
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+
+    def test_conditional_requests_get_304(self):
+        first = self.get()
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=first['ETag']).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=first['Last-Modified']).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_byte_ranges(self):
+        response = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/1024')
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+
+        suffix = self.get(HTTP_RANGE='bytes=-4')
+        self.assertEqual(b''.join(suffix.streaming_content), self.content[-4:])
+
+        unsatisfiable = self.get(HTTP_RANGE='bytes=5000-')
+        self.assertEqual(unsatisfiable.status_code, 416)
+        self.assertEqual(unsatisfiable['Content-Range'], 'bytes */1024')
+
+        # A stale If-Range gets the whole file
+        stale = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"old"')
+        self.assertEqual(stale.status_code, 200)
+
+    def test_sendfile_offload(self):
+        with override_settings(MEDIA_SENDFILE_HEADER='X-Accel-Redirect'):
+            response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.name)
+        self.assertEqual(response.content, b'')
+
+    def test_missing_and_escaping_paths_are_404(self):
+        self.assertEqual(self.get('profile_pics/nope.jpg').status_code, 404)
+        self.assertEqual(self.get('../settings.py').status_code, 404)
+        self.assertEqual(self.client.post('/media/' + self.name).status_code, 405)
+
+    def test_non_images_are_not_rendered_inline(self):
+        self.assertNotIn('Content-Security-Policy', self.get())
+        for name in ('page.html', 'drawing.svg'):
+            with open(os.path.join(settings.MEDIA_ROOT, name), 'wb') as f:
+                f.write(b'<script>alert(1)</script>')
+            for response in (self.get(name), self.get(name, HTTP_RANGE='bytes=0-3')):
+                self.assertTrue(response['Content-Disposition'].startswith('attachment'))
+                self.assertEqual(response['Content-Security-Policy'], 'sandbox')
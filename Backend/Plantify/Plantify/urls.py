@@ -1,10 +1,14 @@
 from django.contrib import admin
-from django.urls import path, include
+import re
+from django.urls import path, include, re_path
 from django.conf import settings
-from django.conf.urls.static import static
+from CropDisease.views import metrics_view
+from .media import serve_media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('crop-disease/', include('CropDisease.urls')),
     path('account/', include('Account.urls')),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    path('metrics', metrics_view, name='metrics'),
+    re_path(r'^%s(?P<path>.+)$' % re.escape(settings.MEDIA_URL.lstrip('/')), serve_media, name='media'),
+]